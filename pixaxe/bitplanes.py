@@ -0,0 +1,253 @@
+import math
+import re
+import struct
+import time
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+from pixaxe.carve import PAYLOAD_PATTERN, PAYLOAD_SIGNATURES
+from pixaxe.helper import signature_mimetype
+from pixaxe.image import DecodedImage
+from pixaxe.steg import TimeBudgetExceeded
+
+# Modes whose pixel data has 8 bits per band
+SUPPORTED_MODES = ("L", "P", "RGB", "RGBA", "CMYK")
+
+# Characters expected in hidden text
+PRINTABLE = re.compile(rb"[\t\n\r\x20-\x7E]*")
+
+
+class BitstreamConfig(object):
+    """One way of reading hidden data out of the bit planes of an image."""
+
+    def __init__(self, plane, channels, channel_slice, bit_order, scan):
+        """
+        Args:
+            plane: Bit plane the data is read from, 0 being the least significant bit.
+            channels: Names of the channels read from each pixel, in order (ie. "bgr").
+            channel_slice: Slice of the channels of the pixel data giving those channels.
+            bit_order: "msb" if the first bit read is the most significant bit of each byte, or "lsb".
+            scan: "xy" to read the pixels along the rows, or "yx" down the columns.
+        """
+        self.plane = plane
+        self.channels = channels
+        self.channel_slice = channel_slice
+        self.bit_order = bit_order
+        self.scan = scan
+
+    @property
+    def name(self):
+        """Name of the configuration, in the style of zsteg (ie. "bit0,rgb,msb,xy")."""
+        return f"bit{self.plane},{self.channels},{self.bit_order},{self.scan}"
+
+    def pack(self, bits):
+        """Pack bits read in this configuration into bytes."""
+        return np.packbits(bits, bitorder="big" if self.bit_order == "msb" else "little").tobytes()
+
+
+class BitstreamPayload(object):
+    """Content found in the bitstream of an extraction configuration."""
+
+    def __init__(self, config, file_type, data):
+        self.config = config
+        self.file_type = file_type
+        self.data = data
+
+
+def bitstream_configs(mode: str, planes: int = 4) -> List[BitstreamConfig]:
+    """List the extraction configurations that apply to an image mode.
+
+    Every bit plane is read from each channel on its own, from all the channels in order and in reverse order
+    (and from the colour channels alone, for images with an alpha channel), with either bit order and scan order.
+
+    Args:
+        mode: Pillow mode of the image, one of SUPPORTED_MODES.
+        planes: Number of bit planes to read from, starting from the least significant.
+
+    Returns:
+        The configurations.
+    """
+    bands = mode.lower()
+    channel_slices = {band: slice(i, i + 1) for i, band in enumerate(bands)}
+    if len(bands) > 1:
+        channel_slices[bands] = slice(None)
+        channel_slices[bands[::-1]] = slice(None, None, -1)
+    if mode == "RGBA":
+        channel_slices["rgb"] = slice(0, 3)
+        channel_slices["bgr"] = slice(2, None, -1)
+    return [
+        BitstreamConfig(plane, channels, channel_slice, bit_order, scan)
+        for scan in ("xy", "yx")
+        for plane in range(planes)
+        for channels, channel_slice in channel_slices.items()
+        for bit_order in ("msb", "lsb")
+    ]
+
+
+def _file_type(data: bytes):
+    """Type of the file starting data, from the payload signatures, or None."""
+    match = PAYLOAD_PATTERN.match(data)
+    if not match:
+        return None
+    file_type = PAYLOAD_SIGNATURES[match.group()][0]
+    # Two byte signatures turn up by chance, so their header is checked as well
+    if file_type == "image/bmp" and signature_mimetype(data[:18]) is None:
+        return None
+    if file_type == "executable/windows":
+        pe_offset = struct.unpack("<I", data[60:64])[0] if len(data) >= 64 else len(data)
+        if data[pe_offset : pe_offset + 4] != b"\x50\x45\x00\x00":
+            return None
+    return file_type
+
+
+def _is_text(data: bytes, min_length: int) -> bool:
+    """Whether data starts with enough printable characters, varied enough not to come from a flat bit plane."""
+    text = PRINTABLE.match(data).group()
+    return len(text) >= min_length and len(set(text)) >= min_length // 2
+
+
+def _strips(decoded: DecodedImage, rows_per_strip: int = 256, deadline: Optional[float] = None):
+    """Pixel data of the image, one strip of rows at a time, shaped (rows, width, bands).
+
+    Raises:
+        TimeBudgetExceeded: The deadline (as per time.monotonic()) passed before the last strip.
+    """
+    width, height = decoded.size
+    for start in range(0, height, rows_per_strip):
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeBudgetExceeded()
+        stop = min(start + rows_per_strip, height)
+        yield np.asarray(decoded.rows(start, stop), dtype=np.uint8).reshape(stop - start, width, -1)
+
+
+def _columns(decoded: DecodedImage, start: int, stop: int, deadline: Optional[float] = None) -> np.ndarray:
+    """Pixel data of some columns of the image, shaped (columns, height, bands) to be read down the columns.
+
+    Raises:
+        TimeBudgetExceeded: The deadline (as per time.monotonic()) passed before the last strip.
+    """
+    return np.concatenate([strip[:, start:stop] for strip in _strips(decoded, deadline=deadline)]).transpose(1, 0, 2)
+
+
+def _column_bits(decoded: DecodedImage, config: BitstreamConfig, deadline: Optional[float] = None):
+    """Bits of an extraction configuration read down the columns, a band of columns at a time.
+
+    The image is read once. The bits of each strip are packed down the columns (the 256 rows of a strip always make
+    whole bytes, only the last strip may not) and put aside, so only an eighth of the size of the planes read is held
+    until the bands of columns are unpacked from them.
+    """
+    packed = []
+    ragged = None
+    for strip in _strips(decoded, deadline=deadline):
+        # Shaped (width, rows * channels), each row of the array being the bits of a column
+        bits = ((strip[..., config.channel_slice] >> config.plane) & 1).transpose(1, 0, 2).reshape(strip.shape[1], -1)
+        if bits.shape[1] % 8:
+            ragged = bits
+        else:
+            packed.append(np.packbits(bits, axis=1))
+    width = decoded.size[0]
+    packed = np.concatenate(packed, axis=1) if packed else np.zeros((width, 0), dtype=np.uint8)
+    ragged = ragged if ragged is not None else np.zeros((width, 0), dtype=np.uint8)
+
+    # Bands of columns of about 4 MB of bits
+    step = max((1 << 22) // (packed.shape[1] * 8 + ragged.shape[1]), 1)
+    for start in range(0, width, step):
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeBudgetExceeded()
+        yield np.concatenate([np.unpackbits(packed[start : start + step], axis=1), ragged[start : start + step]], 1)
+
+
+def bitstream(decoded: DecodedImage, config: BitstreamConfig, deadline: Optional[float] = None) -> bytes:
+    """Read all the data of an image in one extraction configuration.
+
+    The image is read a strip of rows at a time, so only the bitstream is held in full.
+
+    Args:
+        decoded: Image to read.
+        config: Extraction configuration.
+        deadline: Time (as per time.monotonic()) after which reading stops, or None to read the whole bitstream.
+
+    Returns:
+        The bitstream, packed into bytes.
+
+    Raises:
+        TimeBudgetExceeded: The deadline passed before the whole bitstream was read.
+    """
+    if config.scan == "xy":
+        strips = _strips(decoded, deadline=deadline)
+        pieces = ((strip[..., config.channel_slice] >> config.plane) & 1 for strip in strips)
+    else:
+        pieces = _column_bits(decoded, config, deadline)
+
+    packed = []
+    carry = np.zeros(0, dtype=np.uint8)
+    for bits in pieces:
+        bits = np.concatenate([carry, bits.ravel()])
+        # Bits left over from a piece are carried over to the next one, to fill a whole byte
+        whole = len(bits) - len(bits) % 8
+        packed.append(config.pack(bits[:whole]))
+        carry = bits[whole:]
+    return b"".join(packed)
+
+
+def find_bitstream_payloads(
+    decoded: DecodedImage,
+    prefix_size: int = 256,
+    min_text_length: int = 16,
+    planes: int = 4,
+    deadline: Optional[float] = None,
+) -> Iterator[BitstreamPayload]:
+    """Look for files and text hidden in the bit planes of an image, in every extraction configuration.
+
+    The pixels making up the start of the bitstreams (the first rows, and the first columns) are split into bit
+    planes in one pass, and the start of each bitstream is read from views of those planes. Only the bitstreams
+    starting with a known file signature, or with text, are read in full.
+
+    Args:
+        decoded: Image to search, in one of SUPPORTED_MODES.
+        prefix_size: Number of bytes at the start of each bitstream that are checked for a file or text.
+        min_text_length: Minimum number of printable characters a bitstream has to start with to be text.
+        planes: Number of bit planes to read from, starting from the least significant.
+        deadline: Time (as per time.monotonic()) after which the search stops, or None to try every configuration.
+
+    Yields:
+        The payloads found, as they are found. Files extend to the end of their structure, or of the bitstream. Text
+        ends at the first character that isn't printable.
+
+    Raises:
+        TimeBudgetExceeded: The deadline passed before every configuration was tried.
+    """
+    if decoded.mode not in SUPPORTED_MODES:
+        return
+    width, height = decoded.size
+    bits = prefix_size * 8
+    shifts = np.arange(planes, dtype=np.uint8).reshape(-1, 1, 1, 1)
+    # Enough rows and columns for the start of the bitstreams read from a single channel
+    rows = np.asarray(decoded.rows(0, min(math.ceil(bits / width), height)), dtype=np.uint8)
+    prefixes = {
+        "xy": (rows.reshape(rows.shape[0], width, -1)[None] >> shifts) & 1,
+        "yx": (_columns(decoded, 0, min(math.ceil(bits / height), width), deadline)[None] >> shifts) & 1,
+    }
+
+    for config in bitstream_configs(decoded.mode, planes):
+        prefix = config.pack(prefixes[config.scan][config.plane][..., config.channel_slice].ravel()[:bits])
+        file_type = _file_type(prefix)
+        if file_type is None and not _is_text(prefix, min_text_length):
+            continue
+
+        data = bitstream(decoded, config, deadline)
+        if file_type is None:
+            yield BitstreamPayload(config, "text", PRINTABLE.match(data).group())
+            continue
+        payload_end = PAYLOAD_SIGNATURES[PAYLOAD_PATTERN.match(data).group()][1]
+        if payload_end is not None:
+            try:
+                end = payload_end(data, 0)
+            except (IndexError, struct.error):
+                end = None
+            if end is None:
+                # Not a file after all
+                continue
+            data = data[:end]
+        yield BitstreamPayload(config, file_type, data)
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from assemblyline_v4_service.common.result import (
+    Heuristic,
+    ResultGraphSection,
+    ResultJSONSection,
+    ResultKeyValueSection,
+    ResultMemoryDumpSection,
+    ResultSection,
+    ResultTableSection,
+    ResultTextSection,
+    TypeSpecificResultSection,
+)
+
+
+class ResultCache(object):
+    """On-disk cache of the output of the analyses run on an image, keyed by the image content.
+
+    Each entry is a JSON file named after a hash of the image SHA-256, the service version, the name of the analysis
+    and the parameters it ran with. The least recently used entries are evicted once the cache grows past its
+    maximum size.
+    """
+
+    def __init__(self, directory, max_size, version):
+        """
+        Args:
+            directory: Directory the cache is kept in, created if missing.
+            max_size: Maximum size of the cache, in bytes.
+            version: Version of the service, so entries from other versions are never reused.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.version = version
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".json"))
+
+    def _path(self, sha256, analysis, params):
+        key = json.dumps([sha256, self.version, analysis, params], sort_keys=True)
+        return os.path.join(self.directory, f"{hashlib.sha256(key.encode()).hexdigest()}.json")
+
+    def get(self, sha256, analysis, params=None):
+        """Look up the output of an analysis of an image.
+
+        Args:
+            sha256: SHA-256 of the image.
+            analysis: Name of the analysis.
+            params: JSON serializable parameters the analysis ran with.
+
+        Returns:
+            The cached output of the analysis, or None if it isn't cached.
+        """
+        path = self._path(sha256, analysis, params)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            # The modification time of an entry is when it was last used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def set(self, sha256, analysis, value, params=None):
+        """Cache the output of an analysis of an image, evicting the least recently used entries if needed.
+
+        Args:
+            sha256: SHA-256 of the image.
+            analysis: Name of the analysis.
+            value: JSON serializable output of the analysis.
+            params: JSON serializable parameters the analysis ran with.
+        """
+        path = self._path(sha256, analysis, params)
+        try:
+            # Entries are written to a temporary file first, so they are never read half written
+            with tempfile.NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False) as f:
+                json.dump(value, f)
+            size = os.path.getsize(f.name)
+            os.replace(f.name, path)
+        except OSError:
+            return
+        with self._lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is back to 90% of its maximum size."""
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".json")
+        )
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+# Section types which can be cached, by name
+SECTION_TYPES = {
+    section_type.__name__: section_type
+    for section_type in (
+        ResultSection,
+        ResultTextSection,
+        ResultMemoryDumpSection,
+        ResultGraphSection,
+        ResultKeyValueSection,
+        ResultJSONSection,
+        ResultTableSection,
+    )
+}
+
+
+def dump_section(section):
+    """Convert a result section and its subsections to JSON serializable data, to be cached.
+
+    The type of the section, its body, tags and heuristic (with its signatures) are kept, so the section given back
+    by load_section is the one the analysis would have added.
+    """
+    heuristic = section.heuristic
+    if heuristic:
+        heuristic = {
+            "heur_id": heuristic.heur_id,
+            "attack_ids": heuristic.attack_ids,
+            "signatures": heuristic.signatures,
+            "frequency": heuristic.frequency,
+            "score_map": heuristic.score_map,
+        }
+    return {
+        "type": type(section).__name__,
+        "title_text": section.title_text,
+        "body": section.body,
+        "body_format": section.body_format,
+        "body_config": section.body_config,
+        "tags": section.tags,
+        "auto_collapse": section.auto_collapse,
+        "heuristic": heuristic,
+        "subsections": [dump_section(subsection) for subsection in section.subsections],
+    }
+
+
+def load_section(data):
+    """Rebuild a result section and its subsections from the data given by dump_section."""
+    section_type = SECTION_TYPES[data["type"]]
+    heuristic = data["heuristic"]
+    if heuristic:
+        heuristic = Heuristic(
+            heuristic["heur_id"],
+            attack_ids=list(heuristic["attack_ids"]),
+            signatures=dict(heuristic["signatures"]),
+            frequency=heuristic["frequency"] or 1,
+            score_map=dict(heuristic["score_map"]),
+        )
+    kwargs = {"tags": data["tags"], "auto_collapse": data["auto_collapse"], "heuristic": heuristic}
+    if issubclass(section_type, TypeSpecificResultSection):
+        # Type specific sections keep their body as data, which their body property gives as JSON
+        section = section_type(data["title_text"], **kwargs)
+        if data["body"] is not None:
+            section.section_body.set_body(json.loads(data["body"]))
+        section.section_body.config.update(data["body_config"])
+    else:
+        section = section_type(data["title_text"], body=data["body"], body_format=data["body_format"], **kwargs)
+        section.body_config.update(data["body_config"])
+    for subsection in data["subsections"]:
+        section.add_subsection(load_section(subsection))
+    return section
+
+
+class PerceptualIndex(object):
+    """Index of the perceptual hashes of the images analysed before, to find near-duplicates of an image.
+
+    The index is a multi-index hash table: each hash is split into chunks, with a table per chunk. Two hashes within
+    a Hamming distance lower than the number of chunks have at least one chunk in common, so a lookup only compares
+    the hashes sharing a chunk with it. New hashes are appended to a file, which is replayed (and trimmed to its
+    most recent entries) when the index is loaded.
+    """
+
+    def __init__(self, path, bits=256, chunks=16, max_entries=100000):
+        """
+        Args:
+            path: File the index is kept in, created if missing.
+            bits: Size of the hashes, in bits.
+            chunks: Number of chunks the hashes are split into, lookups support distances lower than this.
+            max_entries: Only this many of the most recently added hashes are kept when the index is loaded.
+        """
+        self.path = path
+        self.chunks = chunks
+        self._chunk_bits = bits // chunks
+        self._lock = threading.Lock()
+        self._tables = [{} for _ in range(chunks)]
+        self._entries = set()
+
+        entries = []
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        fingerprint, sha256 = line.split()
+                        entries.append((int(fingerprint, 16), sha256))
+                    except ValueError:
+                        # Partly written line
+                        continue
+        except OSError:
+            pass
+        if len(entries) > max_entries:
+            entries = entries[-max_entries:]
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+                f.writelines(f"{fingerprint:x} {sha256}\n" for fingerprint, sha256 in entries)
+            os.replace(f.name, path)
+        for entry in entries:
+            self._insert(entry)
+
+    def _split(self, fingerprint):
+        mask = (1 << self._chunk_bits) - 1
+        return [(fingerprint >> (i * self._chunk_bits)) & mask for i in range(self.chunks)]
+
+    def _insert(self, entry):
+        if entry in self._entries:
+            return False
+        self._entries.add(entry)
+        for table, chunk in zip(self._tables, self._split(entry[0])):
+            table.setdefault(chunk, []).append(entry)
+        return True
+
+    def add(self, fingerprint, sha256):
+        """Add the perceptual hash of an image to the index.
+
+        Args:
+            fingerprint: Perceptual hash of the image.
+            sha256: SHA-256 of the image.
+        """
+        with self._lock:
+            if not self._insert((fingerprint, sha256)):
+                return
+            try:
+                with open(self.path, "a") as f:
+                    f.write(f"{fingerprint:x} {sha256}\n")
+            except OSError:
+                pass
+
+    def nearest(self, fingerprint, threshold, exclude=None):
+        """Find the image whose perceptual hash is closest to a hash, within a distance threshold.
+
+        Args:
+            fingerprint: Perceptual hash to look up.
+            threshold: Maximum Hamming distance between the hashes, lower than the number of chunks.
+            exclude: SHA-256 of an image to leave out, usually the image being looked up.
+
+        Returns:
+            The SHA-256 of the closest image and the distance to its hash, or None if there is none within threshold.
+        """
+        best = None
+        for table, chunk in zip(self._tables, self._split(fingerprint)):
+            for other, sha256 in table.get(chunk, ()):
+                distance = bin(fingerprint ^ other).count("1")
+                if distance <= threshold and sha256 != exclude and (best is None or distance < best[1]):
+                    best = (sha256, distance)
+        return best
@@ -0,0 +1,246 @@
+import re
+import struct
+import zlib
+
+from pixaxe.helper import image_end, signature_mimetype
+
+
+class Payload(object):
+    """Content carved out of a file."""
+
+    def __init__(self, offset, end, file_type):
+        self.offset = offset
+        self.end = end
+        self.file_type = file_type
+
+    @property
+    def size(self):
+        return self.end - self.offset
+
+
+def _image_end(data, start):
+    # BMP only has a two byte signature, which needs its header checked before trusting it
+    if data[start : start + 2] == b"\x42\x4D" and signature_mimetype(data[start : start + 18]) is None:
+        return None
+    return image_end(data, start)
+
+
+def _zip_end(data, start):
+    """End of a ZIP archive, after its end of central directory record and comment."""
+    first = eocd = data.find(b"\x50\x4B\x05\x06", start)
+    while eocd != -1 and eocd + 22 <= len(data):
+        # The record of the archive itself follows its central directory, where records of archives stored in it
+        # (whose offsets are relative to where they start) don't. The offsets are either relative to the start of
+        # the archive, or to the start of the data when it was appended with its offsets adjusted.
+        directory_size, directory_offset = struct.unpack("<II", data[eocd + 12 : eocd + 20])
+        if eocd in (start + directory_offset + directory_size, directory_offset + directory_size):
+            break
+        eocd = data.find(b"\x50\x4B\x05\x06", eocd + 1)
+    else:
+        # No record matches its central directory, fall back on the first one
+        eocd = first
+    if eocd == -1 or eocd + 22 > len(data):
+        return None
+    return min(eocd + 22 + struct.unpack("<H", data[eocd + 20 : eocd + 22])[0], len(data))
+
+
+def _gzip_end(data, start):
+    """End of a gzip stream, after its trailer. The stream is inflated (throwing away its content) to find it."""
+    # Reserved flag bits are never set, and the operating system is one of those defined
+    if start + 10 > len(data) or data[start + 3] & 0xE0 or 13 < data[start + 9] < 255:
+        return None
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pos = start
+    pending = b""
+    try:
+        while not inflater.eof:
+            if not pending:
+                if pos >= len(data):
+                    # Truncated stream
+                    return None
+                pending = data[pos : pos + 65536]
+                pos += len(pending)
+            # The output is bounded, so decompression bombs are inflated a piece at a time
+            inflater.decompress(pending, 1 << 20)
+            pending = inflater.unconsumed_tail
+    except zlib.error:
+        return None
+    return pos - len(pending) - len(inflater.unused_data)
+
+
+def _vint(data, pos):
+    """Read a RAR 5 variable length integer, returning its value and the offset after it."""
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _rar_end(data, start):
+    """End of a RAR archive, after its end of archive block."""
+    if data[start + 6] == 0x00:
+        # RAR 4: blocks of type, flags and size, with the size of any data following the header
+        pos = start + 7
+        while pos + 7 <= len(data):
+            block_type, flags, size = struct.unpack("<xxBHH", data[pos : pos + 7])
+            if flags & 0x8000:
+                size += struct.unpack("<I", data[pos + 7 : pos + 11])[0]
+            if size < 7:
+                return None
+            pos += size
+            if block_type == 0x7B:
+                return pos if pos <= len(data) else None
+        return None
+    if data[start + 6 : start + 8] == b"\x01\x00":
+        # RAR 5: headers made of a CRC, size, type and flags, with the sizes of any extra area and data
+        pos = start + 8
+        while pos + 4 < len(data):
+            size, header = _vint(data, pos + 4)
+            block_type, fields = _vint(data, header)
+            flags, fields = _vint(data, fields)
+            if flags & 0x01:
+                _, fields = _vint(data, fields)
+            data_size = _vint(data, fields)[0] if flags & 0x02 else 0
+            pos = header + size + data_size
+            if block_type == 5:
+                return pos if pos <= len(data) else None
+        return None
+    return None
+
+
+def _7z_end(data, start):
+    """End of a 7-Zip archive, after the next header its start header points to."""
+    if start + 32 > len(data):
+        return None
+    next_header_offset, next_header_size = struct.unpack("<QQ", data[start + 12 : start + 28])
+    end = start + 32 + next_header_offset + next_header_size
+    return end if end <= len(data) else None
+
+
+def _cab_end(data, start):
+    """End of a cabinet file, from the size in its header."""
+    if start + 12 > len(data):
+        return None
+    size = struct.unpack("<I", data[start + 8 : start + 12])[0]
+    # The size covers the 36 byte header at least
+    if size < 36:
+        return None
+    end = start + size
+    return end if end <= len(data) else None
+
+
+def _pe_end(data, start):
+    """End of a PE file, after its last section (any overlay is left to the next payload)."""
+    if start + 64 > len(data):
+        return None
+    pe_offset = start + struct.unpack("<I", data[start + 60 : start + 64])[0]
+    if data[pe_offset : pe_offset + 4] != b"\x50\x45\x00\x00":
+        return None
+    section_count, optional_header_size = struct.unpack("<2xH12xH", data[pe_offset + 4 : pe_offset + 22])
+    section_table = pe_offset + 24 + optional_header_size
+    end = section_table + 40 * section_count
+    for section in range(section_table, section_table + 40 * section_count, 40):
+        raw_size, raw_pointer = struct.unpack("<II", data[section + 16 : section + 24])
+        if raw_size:
+            end = max(end, start + raw_pointer + raw_size)
+    return end if end <= len(data) else None
+
+
+def _elf_end(data, start):
+    """End of an ELF file, after its section header table."""
+    if start + 64 > len(data):
+        return None
+    elf_class, byte_order = data[start + 4], data[start + 5]
+    if elf_class not in (1, 2) or byte_order not in (1, 2):
+        return None
+    order = "<" if byte_order == 1 else ">"
+    if elf_class == 1:
+        section_header_offset = struct.unpack(order + "I", data[start + 32 : start + 36])[0]
+        entry_size, entry_count = struct.unpack(order + "HH", data[start + 46 : start + 50])
+    else:
+        section_header_offset = struct.unpack(order + "Q", data[start + 40 : start + 48])[0]
+        entry_size, entry_count = struct.unpack(order + "HH", data[start + 58 : start + 62])
+    end = start + section_header_offset + entry_size * entry_count
+    return end if start < end <= len(data) else None
+
+
+def _pdf_end(data, start):
+    """End of a PDF document, after its last end-of-file marker."""
+    eof = data.rfind(b"%%EOF", start)
+    return eof + 5 if eof != -1 else None
+
+
+# Signature of each type of payload, with the function finding where it ends.
+# Payloads without a function extend up to the next payload, or the end of the data.
+PAYLOAD_SIGNATURES = {
+    b"\x42\x4D": ("image/bmp", _image_end),
+    b"\x47\x49\x46\x38\x37\x61": ("image/gif", _image_end),
+    b"\x47\x49\x46\x38\x39\x61": ("image/gif", _image_end),
+    b"\xFF\xD8\xFF": ("image/jpeg", _image_end),
+    b"\x00\x00\x00\x0C\x6A\x50\x20\x20\x0D\x0A": ("image/jp2", _image_end),
+    b"\x89\x50\x4E\x47\x0D\x0A\x1A\x0A": ("image/png", _image_end),
+    b"\x50\x4B\x03\x04": ("archive/zip", _zip_end),
+    b"\x52\x61\x72\x21\x1A\x07": ("archive/rar", _rar_end),
+    b"\x37\x7A\xBC\xAF\x27\x1C": ("archive/7-zip", _7z_end),
+    b"\x1F\x8B\x08": ("archive/gzip", _gzip_end),
+    b"\x4D\x53\x43\x46\x00\x00\x00\x00": ("archive/cabinet", _cab_end),
+    b"\x4D\x5A": ("executable/windows", _pe_end),
+    b"\x7F\x45\x4C\x46": ("executable/linux", _elf_end),
+    b"\x25\x50\x44\x46\x2D": ("document/pdf", _pdf_end),
+    b"\x23\x21\x2F": ("code/shell", None),
+    b"\x3C\x3F\x70\x68\x70": ("code/php", None),
+    b"\x3C\x73\x63\x72\x69\x70\x74": ("code/html", None),
+}
+
+# Every signature in a single pattern, so the data is scanned once whatever the number of signatures
+PAYLOAD_PATTERN = re.compile(b"|".join(re.escape(signature) for signature in PAYLOAD_SIGNATURES))
+
+
+def carve_payloads(data, start=0, end=None, min_size=16):
+    """Carve the payloads out of a region of data in one pass.
+
+    Payloads whose structure gives their size are skipped over as a whole, so the scan resumes after them and
+    catches payloads chained one after the other.
+
+    Args:
+        data: Raw data, as bytes or any buffer supporting find (e.g. a memory map).
+        start: Offset of the start of the region to carve.
+        end: Offset of the end of the region to carve, defaults to the end of the data.
+        min_size: Payloads smaller than this are ignored.
+
+    Returns:
+        The payloads found, in order of their offset.
+    """
+    end = len(data) if end is None else end
+    payloads = []
+    pos = start
+    while pos < end:
+        match = PAYLOAD_PATTERN.search(data, pos, end)
+        if not match:
+            break
+
+        offset = match.start()
+        file_type, payload_end = PAYLOAD_SIGNATURES[match.group()]
+        if payload_end is not None:
+            try:
+                payload_end = payload_end(data, offset)
+            except (IndexError, struct.error):
+                payload_end = None
+            if payload_end is None or payload_end <= offset or payload_end > end:
+                # Not a payload after all (one ending where it starts would never move the scan forward)
+                pos = offset + 1
+                continue
+
+        if payloads and payloads[-1].end is None:
+            # The previous payload had no known size, it ends where this one starts
+            payloads[-1].end = offset
+        payloads.append(Payload(offset, payload_end, file_type))
+        pos = payload_end if payload_end is not None else match.end()
+
+    if payloads and payloads[-1].end is None:
+        payloads[-1].end = end
+    return [payload for payload in payloads if payload.size >= min_size]
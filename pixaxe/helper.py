@@ -1,150 +1,286 @@
-import magic
-import re
 import struct
 
+# MIME type of image formats that can be recognised from their signature alone
+IMAGE_SIGNATURES = {
+    b"\x89\x50\x4E\x47\x0D\x0A\x1A\x0A": "image/png",
+    b"\x47\x49\x46\x38\x37\x61": "image/gif",
+    b"\x47\x49\x46\x38\x39\x61": "image/gif",
+    b"\xFF\xD8\xFF": "image/jpeg",
+    b"\x00\x00\x00\x0C\x6A\x50\x20\x20\x0D\x0A\x87\x0A": "image/jp2",
+}
 
-def mimetype(f, t):
-    """Determine if Magic-MIME file type of data matches desired file type.
+# Sizes of the known BMP info headers (BITMAPCOREHEADER through BITMAPV5HEADER)
+BMP_INFO_HEADER_SIZES = (12, 16, 40, 52, 56, 64, 108, 124)
+
+
+def signature_mimetype(f):
+    """Identify image data from its signature, without going through libmagic.
 
     Args:
         f: Raw data to evaluate.
-        t: File type to compare (string).
 
     Returns:
-        True if file type matches t, or False.
+        The MIME type of the image, or None if the signature isn't one of the known image formats.
     """
-    is_t = False
-    m = magic.Magic(mime=True)
-    ftype = m.from_buffer(f)
-    if t in ftype:
-        is_t = True
-    return is_t
+    for header, ftype in IMAGE_SIGNATURES.items():
+        if f[: len(header)] == header:
+            return ftype
+    # BMP only has a two byte signature, so also check that the header is consistent
+    if f[:2] == b"\x42\x4D" and len(f) >= 18 and f[6:10] == b"\x00\x00\x00\x00":
+        if struct.unpack("<I", f[14:18])[0] in BMP_INFO_HEADER_SIZES:
+            return "image/bmp"
+    return None
 
 
-def bmp_dump(data):
-    """BMP embedded file extraction. Looks for traits of known BMP file structure to find embedded BMP data.
+def steghide_capable(f):
+    """Determine if data is in one of the formats steghide can hide data in (JPEG, BMP, WAV and AU).
 
     Args:
-        data: Raw data to search.
+        f: Raw data to evaluate, at least its first 18 bytes.
 
     Returns:
-        BMP data if discovered, or original data.
+        True if steghide can carry data in this format, or False.
     """
-    # noinspection PyBroadException
-    try:
-        # Byte offset to start of image
-        soi = struct.unpack("<I", data[10:14])[0]
-        # Size of image data, including padding -- potentially unreliable
-        sizei = struct.unpack("<I", data[34:38])[0]
-        # Width in pixels
-        # wi = struct.unpack('<I', data[18:22])[0]
-        # Height in pixels
-        # hi = struct.unpack('<I', data[22:26])[0]
-        # Depth
-        # di = struct.unpack('<H', data[26:28])[0]
-        # Bits per pixel
-        # bpi = struct.unpack('<H', data[28:30])[0]
-        # Image bytes
-        # sizei = (wi*hi*di*bpi)/8
-        bmp_data = data[0 : (soi + sizei)]
-        verify_bmp = mimetype(bmp_data, "image")
-        if not verify_bmp:
-            return data
-        return bmp_data
-    except Exception:
-        return data
+    if signature_mimetype(f) in ("image/jpeg", "image/bmp"):
+        return True
+    return (f[:4] == b"\x52\x49\x46\x46" and f[8:12] == b"\x57\x41\x56\x45") or f[:4] == b"\x2E\x73\x6E\x64"
 
 
-def jpg2_dump(data):
-    """Looks for traits of known JPEG 2000 file structure to confirm that data is likely JPEG 2000 data.
+def _jpeg2000_end(data, start=0):
+    """Find the end of JPEG 2000 data from the end of its codestream(s).
 
     Args:
         data: Raw data to search.
+        start: Offset of the JPEG 2000 signature box.
 
     Returns:
-        JPEG 2000 data if discovered, or original data.
+        Offset of the end of the image, or None if it can't be found.
     """
     ftyps = {
-        "\x6a\x70\x32\x20": "jp2",
-        "\x6a\x70\x78\x20": "jpf",
-        "\x6a\x70\x6d\x20": "jpm",
-        "\x6d\x6a\x70\x32": "mj2",
-        "\xFF\x4F\xFF\x51": "j2c",
+        b"\x6a\x70\x32\x20": "jp2",
+        b"\x6a\x70\x78\x20": "jpf",
+        b"\x6a\x70\x6d\x20": "jpm",
+        b"\x6d\x6a\x70\x32": "mj2",
+        b"\xFF\x4F\xFF\x51": "j2c",
     }
-    trailer = "\xFF\xD9"
-    cdata = data
-    end = 0
+    trailer = b"\xFF\xD9"
     try:
-        jtype = data[20:24]
+        jtype = data[start + 20 : start + 24]
         if jtype in ftyps:
             file_type = ftyps[jtype]
         else:
             return
+        end = start
         while True:
-            findend = cdata.find(trailer)
+            findend = data.find(trailer, end)
             if findend == -1:
                 return
-            else:
-                end += findend + 2
+            end = findend + 2
             # Another jp2 codestream
-            if cdata[findend + 6 : findend + 10] == "jp2c":
-                cdata = cdata[findend + 2 :]
+            if data[end + 4 : end + 8] == b"jp2c":
+                continue
             # Possible .mov file types
-            elif file_type == "mj2" and cdata[findend + 6 : findend + 10] in [
-                "free",
-                "mdat",
-                "moov",
-                "pnot",
-                "skip",
-                "wide",
+            elif file_type == "mj2" and data[end + 4 : end + 8] in [
+                b"free",
+                b"mdat",
+                b"moov",
+                b"pnot",
+                b"skip",
+                b"wide",
             ]:
-                msize = struct.unpack(">I", cdata[findend + 2 : findend + 6])[0]
-                jp2_data = data[0 : end + msize]
-                break
+                msize = struct.unpack(">I", data[end : end + 4])[0]
+                return end + msize
             else:
-                jp2_data = data[0:end]
-                break
-        return jp2_data
+                return end
     except Exception:
         return
 
 
+def _png_end(data, start=0):
+    """Walk the PNG chunks up to IEND.
+
+    Args:
+        data: Raw data to search.
+        start: Offset of the PNG signature.
+
+    Returns:
+        Offset of the end of the IEND chunk, or None if the data ends first.
+    """
+    pos = start + 8
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos : pos + 8])
+        # Chunk length and type, followed by the chunk data and its CRC
+        pos += 12 + length
+        if chunk_type == b"IEND":
+            return pos if pos <= len(data) else None
+    return None
+
+
+def _jpeg_end(data, start=0):
+    """Walk the JPEG markers up to EOI, skipping over the entropy-coded data that follows each SOS segment.
+
+    Args:
+        data: Raw data to search.
+        start: Offset of the SOI marker.
+
+    Returns:
+        Offset of the end of the EOI marker, or None if the data ends first.
+    """
+    pos = start + 2
+    while pos + 2 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+        elif marker == 0xD9:
+            return pos + 2
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Markers without a length
+            pos += 2
+        else:
+            pos += 2 + struct.unpack(">H", data[pos + 2 : pos + 4])[0]
+            if marker == 0xDA:
+                # Entropy-coded data runs until a marker other than a stuffed byte (FF00) or a restart (RSTn)
+                while True:
+                    pos = data.find(b"\xFF", pos)
+                    if pos == -1 or pos + 1 >= len(data):
+                        return None
+                    following = data[pos + 1]
+                    if following == 0x00 or following == 0xFF or 0xD0 <= following <= 0xD7:
+                        pos += 1 if following == 0xFF else 2
+                    else:
+                        break
+    return None
+
+
+def _gif_sub_blocks_end(data, pos):
+    """Skip a sequence of GIF data sub-blocks, returning the offset after the block terminator."""
+    while pos < len(data):
+        size = data[pos]
+        pos += 1 + size
+        if size == 0:
+            return pos
+    return None
+
+
+def _gif_end(data, start=0):
+    """Walk the GIF blocks up to the trailer.
+
+    Args:
+        data: Raw data to search.
+        start: Offset of the GIF signature.
+
+    Returns:
+        Offset of the end of the trailer, or None if the data ends first.
+    """
+    if len(data) < start + 13:
+        return None
+    flags = data[start + 10]
+    pos = start + 13
+    if flags & 0x80:
+        # Global color table
+        pos += 3 << ((flags & 0x07) + 1)
+    while pos is not None and pos < len(data):
+        block = data[pos]
+        if block == 0x3B:
+            return pos + 1
+        elif block == 0x21:
+            # Extension: label, then data sub-blocks
+            pos = _gif_sub_blocks_end(data, pos + 2)
+        elif block == 0x2C:
+            # Image descriptor, optional local color table, LZW minimum code size, then image data sub-blocks
+            if pos + 10 > len(data):
+                return None
+            flags = data[pos + 9]
+            pos += 10
+            if flags & 0x80:
+                pos += 3 << ((flags & 0x07) + 1)
+            pos = _gif_sub_blocks_end(data, pos + 1)
+        else:
+            return None
+    return None
+
+
+def _bmp_end(data, start=0):
+    """Read the end of the BMP image from its header.
+
+    Args:
+        data: Raw data to search.
+        start: Offset of the BMP signature.
+
+    Returns:
+        Offset of the end of the image, or None if the header doesn't describe one.
+    """
+    if len(data) < start + 38:
+        return None
+    file_size, soi = struct.unpack("<I4xI", data[start + 2 : start + 14])
+    # A size of 0 would end the image where it starts
+    if 0 < file_size and soi <= file_size <= len(data) - start:
+        return start + file_size
+    # The file size is unreliable, fall back on the offset and size of the pixel data
+    image_size = struct.unpack("<I", data[start + 34 : start + 38])[0]
+    if image_size and soi + image_size <= len(data) - start:
+        return start + soi + image_size
+    return None
+
+
+# Signature of each supported image format, with the function finding where its image data ends
+IMAGE_STRUCTURES = {
+    b"\x42\x4D": _bmp_end,
+    b"\x47\x49\x46\x38\x37\x61": _gif_end,
+    b"\x47\x49\x46\x38\x39\x61": _gif_end,
+    b"\xFF\xD8": _jpeg_end,
+    b"\x00\x00\x00\x0C\x6A\x50\x20\x20\x0D\x0A": _jpeg2000_end,
+    b"\x89\x50\x4E\x47\x0D\x0A\x1A\x0A": _png_end,
+}
+
+
+def image_end(data, start=0):
+    """Walk the structure of an image to find where its data really ends.
+
+    Args:
+        data: Raw data, as bytes or any buffer supporting find (e.g. a memory map).
+        start: Offset of the image in data.
+
+    Returns:
+        Offset of the end of the image, or None if the format isn't known or the image is truncated.
+    """
+    for header, structure_end in IMAGE_STRUCTURES.items():
+        if data[start : start + len(header)] != header:
+            continue
+        try:
+            return structure_end(data, start)
+        except (IndexError, struct.error):
+            return None
+    return None
+
+
 def find_additional_content(data):
     """Looks for appended file content attached to an image.
 
+    The structure of the image is walked in a single pass to find where the image really ends, so the data is
+    never copied.
+
     Args:
-        data: image content in bytes
+        data: image content, as bytes or any buffer supporting find (e.g. a memory map)
 
     Returns:
-        Embedded file data if found, or None.
+        A memoryview of the embedded file data if found, or None.
     """
-    PAT_FILEMARKERS = {
-        # Header, Trailer, additional methods
-        "bmp": (b"\x42\x4D", None, bmp_dump),
-        "gif": (b"\x47\x49\x46\x38.\x61.{19,}\x2C.{9,}", b"\x00\x3B", None),
-        "jpeg": (b"\xFF\xD8.{16,}\xFF\xDB.{3,}\xFF\xDA.{13,}", b"\xFF\xD9", None),
-        "jpeg2000": (b"\x00\x00\x00\x0C\x6A\x50\x20\x20\x0D\x0A", None, jpg2_dump),
-        "png": (b"\x89\x50\x4E\x47", b"\x49\x45\x4E\x44.{4}", None),
-    }
+    end = image_end(data)
+    if end is None:
+        return
+
+    # Remove trailing NULL bytes
+    trailer_end = len(data)
+    while trailer_end > end and data[trailer_end - 1] == 0:
+        block_start = max(end, trailer_end - 65536)
+        trailer_end = block_start + len(data[block_start:trailer_end].rstrip(b"\x00"))
+        if trailer_end > block_start:
+            break
 
-    for _, tinfo in iter(PAT_FILEMARKERS.items()):
-        # Build up the regex
-        embed_regex = re.compile(tinfo[0] + b".+" + (tinfo[1] or b""), re.DOTALL)
-        # Find the pattern that should match the image.
-        img_match = re.match(embed_regex, data)
-        if img_match:
-            img_data = img_match.group()
-            # Go to extraction module if there is one
-            if tinfo[2] is not None:
-                img_data = tinfo[2](img_data)
-
-            # Otherwise extract data as-is (regex is considered good enough)
-            leftovers = data.replace(img_data, b"")
-
-            # Remove trailing NULL bytes
-            leftovers = re.sub(b"[\x00]*$", b"", leftovers)
-
-            if len(leftovers) > 15:
-                # Recursively inspect the leftovers for more embedded content
-                return leftovers
+    if trailer_end - end > 15:
+        return memoryview(data)[end:trailer_end]
     return
@@ -0,0 +1,326 @@
+import mmap
+import os
+import zlib
+from typing import List
+
+import numpy as np
+from PIL import Image, ImageMode
+
+
+def dhash(image: Image.Image, hash_size: int = 16) -> int:
+    """Compute the difference hash of an image.
+
+    The image is reduced to a (hash_size + 1) x hash_size greyscale thumbnail and each bit of the hash records
+    whether a pixel is brighter than its right-hand neighbour, so small visual changes only flip a few bits.
+
+    Args:
+        image: Pillow image to fingerprint.
+        hash_size: Number of rows (and comparisons per row) in the hash.
+
+    Returns:
+        The hash as an integer of hash_size * hash_size bits.
+    """
+    thumbnail = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of bits that differ between two hashes."""
+    return bin(a ^ b).count("1")
+
+
+def sample_frames(changes: List[int], budget: int) -> List[int]:
+    """Pick which frames of an animation to keep when only a limited number of them can be analysed.
+
+    The first and last frames are always kept, followed by the frames that change the most from the one before them
+    (scene changes), and the rest of the budget is spread evenly across the animation.
+
+    Args:
+        changes: For each frame, how much it differs from the frame before it.
+        budget: Maximum number of frames to keep. Every frame is kept if this is 0 or less.
+
+    Returns:
+        The positions of the frames to keep, in order.
+    """
+    count = len(changes)
+    if budget <= 0 or count <= budget:
+        return list(range(count))
+    if budget == 1:
+        return [0]
+
+    keep = {0, count - 1}
+    by_change = sorted(range(1, count - 1), key=lambda position: changes[position], reverse=True)
+    keep.update(by_change[: (budget - len(keep)) // 2])
+    for position in np.linspace(0, count - 1, budget).round().astype(int):
+        if len(keep) >= budget:
+            break
+        keep.add(int(position))
+    for position in by_change:
+        if len(keep) >= budget:
+            break
+        keep.add(position)
+    return sorted(keep)
+
+
+def ocr_text(path: str) -> str:
+    """Extract the text of an image with Tesseract, as the service base does when adding an image with OCR.
+
+    Defined at module level so it can be run in a process pool.
+
+    Args:
+        path: Path of the image file.
+
+    Returns:
+        The text found in the image, or an empty string if Tesseract doesn't support the image.
+    """
+    import pytesseract
+
+    try:
+        return pytesseract.image_to_string(Image.open(path), timeout=15)  # Stop OCR after 15 seconds
+    except (TypeError, RuntimeError):
+        return ""
+
+
+class _PngRows(object):
+    """Rows of a PNG image, decoded in order from the compressed image data of the file.
+
+    Each row is filtered against the row above it, so only the last decoded row is kept to carry on from, and rows
+    are never held in memory beyond the strip asked for. Asking for a row before the last one decoded starts over
+    from the first row.
+    """
+
+    # Number of rows decoded at a time on the way to the first row of a strip
+    batch_rows = 256
+
+    def __init__(self, contents, offset, mode, size):
+        """
+        Args:
+            contents: Raw content of the file.
+            offset: Offset of the data of the first IDAT chunk.
+            mode: Pillow mode of the image, with 8 bits per band.
+            size: Width and height of the image.
+        """
+        self.contents = contents
+        self.offset = offset
+        self.mode = mode
+        self.width = size[0]
+        # Each row starts with the type of filter it went through
+        self.stride = 1 + size[0] * len(ImageMode.getmode(mode).bands)
+        self._restart()
+
+    def _restart(self):
+        self.next_row = 0
+        # Last decoded row, as raw bytes
+        self.previous = None
+        # The first chunk header is read when the compressed data of the (fake) chunk before it runs out
+        self.position = self.chunk_end = self.offset - 12
+        self.inflater = zlib.decompressobj()
+
+    def _compressed(self):
+        """Next piece of the compressed image data, or b"" past the last IDAT chunk."""
+        while self.position == self.chunk_end:
+            # Move on to the next chunk, skipping the CRC of this one
+            header = self.contents[self.chunk_end + 4 : self.chunk_end + 12]
+            if len(header) < 8 or header[4:] != b"IDAT":
+                return b""
+            self.position = self.chunk_end + 12
+            self.chunk_end = self.position + int.from_bytes(header[:4], "big")
+        # Large chunks are read a piece at a time
+        data = self.contents[self.position : min(self.chunk_end, self.position + 65536)]
+        self.position += len(data)
+        return data
+
+    def _decode(self, count):
+        """Decode the next count rows."""
+        size = count * self.stride
+        filtered = bytearray()
+        while len(filtered) < size:
+            compressed = self.inflater.unconsumed_tail or self._compressed()
+            data = self.inflater.decompress(compressed, size - len(filtered))
+            if not data and not compressed:
+                raise OSError("image file is truncated")
+            filtered += data
+        if self.previous is not None:
+            # Pillow unfilters the rows, from the last decoded row stored as is (filter type 0)
+            filtered[:0] = b"\0" + self.previous
+        height = len(filtered) // self.stride
+        rows = Image.frombytes(self.mode, (self.width, height), zlib.compress(filtered, 0), "zip", self.mode)
+        rows = np.asarray(rows)[height - count :]
+        self.previous = rows[-1].tobytes()
+        self.next_row += count
+        return rows
+
+    def rows(self, start, stop):
+        """Pixel data of a strip of rows, shaped like the array of the Pillow image."""
+        if start < self.next_row:
+            self._restart()
+        while self.next_row < start:
+            self._decode(min(start - self.next_row, self.batch_rows))
+        if stop <= start:
+            return np.asarray(Image.new(self.mode, (self.width, 0)))
+        return self._decode(stop - start)
+
+
+class DecodedImage(object):
+    """Submitted image, decoded once per request and shared by every analysis stage.
+
+    Nothing is read until a stage asks for it, so files that Pillow can't handle only raise (Pillow's own errors)
+    in the stages that need pixel data. Stages that work on the raw bytes share a read-only memory map of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._contents = None
+        self._image = None
+        self._array = None
+        self._rgb = None
+        self._png_rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def contents(self):
+        """Raw content of the file, memory-mapped so that it is only read from disk as it is accessed."""
+        if self._contents is None:
+            with open(self.path, "rb") as fh:
+                if os.fstat(fh.fileno()).st_size:
+                    self._contents = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    # Empty files can't be mapped
+                    self._contents = b""
+        return self._contents
+
+    @property
+    def image(self) -> Image.Image:
+        """Pillow image, positioned on the first frame."""
+        if self._image is None:
+            self._image = Image.open(self.path)
+        return self._image
+
+    @property
+    def format(self):
+        return self.image.format
+
+    @property
+    def mode(self):
+        return self.image.mode
+
+    @property
+    def size(self):
+        return self.image.size
+
+    @property
+    def array(self) -> np.ndarray:
+        """Pixel data of the first frame, shaped (height, width) or (height, width, channels)."""
+        if self._array is None:
+            self._array = np.asarray(self.image)
+        return self._array
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        """Pixel data of a strip of rows of the first frame, shaped like array.
+
+        Images that haven't been decoded yet are read from the memory-mapped file, so only the strip is ever held in
+        memory: uncompressed images straight from the file, PNG images by decoding their rows in order (going back
+        to an earlier row starts over from the first one). Other images are decoded by Pillow (once), and the strip
+        copied out. Images past Pillow's decompression bomb limit can't be opened at all, so are never read here.
+
+        Args:
+            start: First row of the strip.
+            stop: Row after the last row of the strip.
+
+        Returns:
+            The pixel data, shaped (stop - start, width) or (stop - start, width, channels).
+        """
+        if self._array is not None:
+            return self._array[start:stop]
+        if self._png_layout():
+            if self._png_rows is None:
+                self._png_rows = _PngRows(self.contents, self.image.tile[0][2], self.mode, self.size)
+            return self._png_rows.rows(start, stop)
+        layout = self._raw_layout()
+        if layout is None:
+            return np.asarray(self.image.crop((0, start, self.size[0], stop)))
+
+        offset, rawmode, stride, orientation = layout
+        # Bottom-up images store the last row first
+        first = self.size[1] - stop if orientation < 0 else start
+        data = self.contents[offset + first * stride : offset + (first + stop - start) * stride]
+        strip = Image.frombytes(self.mode, (self.size[0], stop - start), data, "raw", rawmode, stride, orientation)
+        return np.asarray(strip)
+
+    def _png_layout(self):
+        """Whether the image is a PNG image that hasn't been decoded yet, whose rows can be decoded in order."""
+        image = self.image
+        if image.format != "PNG" or len(image.tile) != 1 or getattr(image, "n_frames", 1) != 1:
+            return False
+        codec, extents, _, rawmode = image.tile[0]
+        # Interlaced images store their rows in several passes, and packed or 16 bit ones differ from the image mode
+        return (
+            codec == "zip"
+            and tuple(extents) == (0, 0) + image.size
+            and not image.info.get("interlace")
+            and rawmode == image.mode
+            and ImageMode.getmode(image.mode).typestr == "|u1"
+        )
+
+    def _raw_layout(self):
+        """Offset, raw mode, row stride and orientation of the pixel data of an uncompressed image that hasn't been
+        decoded yet, or None if the pixel data can't be read from the file directly."""
+        image = self.image
+        # Pillow empties the tile list once the image is loaded
+        if len(image.tile) != 1:
+            return None
+        codec, extents, offset, args = image.tile[0]
+        if codec != "raw" or tuple(extents) != (0, 0) + image.size:
+            return None
+        if isinstance(args, str):
+            args = (args,)
+        rawmode, stride, orientation = tuple(args) + (0, 1)[len(args) - 1 :]
+        if stride == 0:
+            # Rows are packed, which is only simple to size for 8 bits per band
+            mode = ImageMode.getmode(image.mode)
+            if rawmode != image.mode or mode.typestr != "|u1":
+                return None
+            stride = image.size[0] * len(mode.bands)
+        if stride < 0 or offset + stride * image.size[1] > len(self.contents):
+            # Truncated images are left to Pillow
+            return None
+        return offset, rawmode, stride, orientation
+
+    @property
+    def rgb(self) -> Image.Image:
+        """First frame converted to RGB."""
+        if self._rgb is None:
+            self._rgb = self.image.convert("RGB")
+        return self._rgb
+
+    def frames(self):
+        """Iterate over the frames of the image, moving back to the first frame once done.
+
+        Yields:
+            The Pillow image, positioned on each frame in turn.
+        """
+        try:
+            while True:
+                yield self.image
+                self.image.seek(self.image.tell() + 1)
+        except EOFError:
+            pass
+        finally:
+            self.image.seek(0)
+
+    def close(self):
+        if self._image is not None:
+            self._image.close()
+        if isinstance(self._contents, mmap.mmap):
+            self._contents.close()
+        self._contents = None
+        self._image = None
+        self._array = None
+        self._rgb = None
+        self._png_rows = None
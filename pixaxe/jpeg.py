@@ -0,0 +1,147 @@
+import math
+from typing import List, Optional
+
+import jpeglib
+import numpy as np
+from scipy.stats import chi2
+
+# Comment written into every image by the JPEG encoder of the F5 steganography tool
+F5_ENCODER_COMMENT = b"JPEG Encoder Copyright 1998, James R. Weeks and BioElectronics."
+
+# Position of each coefficient of a block in zigzag order, the order they are stored in the file
+_ZIGZAG = np.array(
+    [
+        0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5, 12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14,
+        21, 28, 35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51, 58, 59, 52, 45, 38, 31, 39, 46, 53, 60,
+        61, 54, 47, 55, 62, 63,
+    ]
+)  # fmt: skip
+
+
+class JpegCoefficients(object):
+    """Quantised DCT coefficients of a JPEG image, read from its entropy-coded data."""
+
+    def __init__(self, ac, blocks, comments):
+        # Non-zero AC coefficients of every block, in the order they are stored in the file
+        self.ac = ac
+        self.blocks = blocks
+        self.comments = comments
+
+    @property
+    def ac_count(self):
+        """Number of AC coefficients (zero or not) in the blocks read."""
+        return self.blocks * 63
+
+
+def _file_order(components, sampling, width, height) -> np.ndarray:
+    """Put the blocks of the components of an image in the order a baseline encoder interleaves them in the file.
+
+    Args:
+        components: Blocks of each component, shaped (rows, columns, 8, 8).
+        sampling: Vertical and horizontal sampling factors of each component.
+        width: Width of the image, in pixels.
+        height: Height of the image, in pixels.
+
+    Returns:
+        The blocks, shaped (blocks, 64).
+    """
+    if len(components) == 1:
+        # Single component images are stored one block per MCU, row by row
+        return components[0].reshape(-1, 64)
+    v_max = max(v for v, _ in sampling)
+    h_max = max(h for _, h in sampling)
+    mcu_rows = math.ceil(height / (8 * v_max))
+    mcu_columns = math.ceil(width / (8 * h_max))
+    mcus = []
+    for blocks, (v, h) in zip(components, sampling):
+        # libjpeg leaves out the blocks padding the components to a whole number of MCUs. They are put back as zeros,
+        # which only holds the place of their coefficients as the zero coefficients are left out.
+        padded = np.zeros((mcu_rows * v, mcu_columns * h, 64), dtype=blocks.dtype)
+        padded[: blocks.shape[0], : blocks.shape[1]] = blocks.reshape(blocks.shape[0], blocks.shape[1], 64)
+        # Each MCU holds v rows of h blocks of the component, row by row
+        mcus.append(padded.reshape(mcu_rows, v, mcu_columns, h, 64).transpose(0, 2, 1, 3, 4).reshape(-1, v * h, 64))
+    return np.concatenate(mcus, axis=1).reshape(-1, 64)
+
+
+def read_coefficients(path: str) -> Optional[JpegCoefficients]:
+    """Read the quantised DCT coefficients of a JPEG image with libjpeg, without decoding its pixels.
+
+    Args:
+        path: Path to the image.
+
+    Returns:
+        The coefficients read, or None if the image isn't a JPEG image libjpeg can read.
+    """
+    try:
+        image = jpeglib.read_dct(path)
+        components = [blocks for blocks in (image.Y, image.Cb, image.Cr, image.K) if blocks is not None]
+        sampling = image.samp_factor.tolist()
+        width, height = image.width, image.height
+        comments = [bytes(marker.content) for marker in image.markers if marker.type == jpeglib.JPEG_COM]
+    except (OSError, ValueError):
+        return None
+    if not components:
+        return None
+
+    blocks = _file_order(components, sampling, width, height)
+    ac = blocks[:, _ZIGZAG[1:]].ravel()
+    return JpegCoefficients(ac[ac != 0], sum(c.shape[0] * c.shape[1] for c in components), comments)
+
+
+def pair_of_values(ac: np.ndarray, steps: int = 20) -> List[float]:
+    """Westfeld and Pfitzmann's pair of values chi-square test, on increasing parts of the AC coefficients.
+
+    Embedding in the LSB of the coefficients (as JSteg and OutGuess 0.1 do) evens out the counts of each pair of
+    values differing only by their LSB. JSteg leaves the coefficients 0 and 1 alone, so their pair is left out.
+
+    Args:
+        ac: Non-zero AC coefficients, in the order they are stored.
+        steps: Number of increasing parts of the coefficients to test, the last being all of them.
+
+    Returns:
+        The probability of embedding (the p-value of the test) over the first 1/steps, 2/steps... of the coefficients.
+    """
+    used = ac[(ac != 0) & (ac != 1)]
+    pairs, inverse = np.unique(used >> 1, return_inverse=True)
+    ends = np.linspace(0, len(used), steps + 1).astype(np.int64)
+    segment = np.repeat(np.arange(steps), np.diff(ends))
+    # Counts of the even and odd value of each pair, accumulated over the parts
+    counts = np.bincount((segment * len(pairs) + inverse) * 2 + (used & 1), minlength=steps * len(pairs) * 2)
+    counts = np.cumsum(counts.reshape(steps, len(pairs), 2), axis=0)
+
+    p_values = []
+    for even, odd in zip(counts[..., 0], counts[..., 1]):
+        expected = (even + odd) / 2
+        # Pairs too rare to test are left out, as the chi-square approximation needs 5 expected occurrences
+        tested = expected >= 5
+        if np.count_nonzero(tested) < 2:
+            p_values.append(0.0)
+            continue
+        statistic = np.sum((even[tested] - expected[tested]) ** 2 / expected[tested])
+        p_values.append(float(chi2.sf(statistic, np.count_nonzero(tested) - 1)))
+    return p_values
+
+
+def dct_statistics(coefficients: JpegCoefficients, steps: int = 20) -> dict:
+    """Run the coefficient histogram tests on the coefficients of an image.
+
+    Args:
+        coefficients: Coefficients read from the image.
+        steps: Number of increasing parts of the coefficients the pair of values test is run on.
+
+    Returns:
+        JSON serializable statistics: the blocks and coefficients read, the fraction of AC coefficients that are zero,
+        the pair of values p-values, the number of coefficients they were tested on, and whether the F5 encoder wrote
+        the image.
+    """
+    ac = coefficients.ac
+    # Values 0 and 1 are never used for embedding by JSteg
+    usable = int(np.count_nonzero(ac != 1))
+    return {
+        "blocks": coefficients.blocks,
+        "non_zero_ac": len(ac),
+        "zero_ac_fraction": 1 - len(ac) / coefficients.ac_count,
+        "usable_ac": usable,
+        "pair_of_values": pair_of_values(ac, steps) if usable else [],
+        "f5_encoder": any(comment.startswith(F5_ENCODER_COMMENT) for comment in coefficients.comments),
+    }
@@ -1,41 +1,110 @@
+import base64
 import hashlib
 import os
 import re
 import subprocess
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from tempfile import NamedTemporaryFile
 from typing import Optional
 
 from assemblyline.common.str_utils import safe_str
 from assemblyline.odm.base import FULL_URI
 from assemblyline_v4_service.common.base import ServiceBase
+from assemblyline_v4_service.common.ocr import detections
 from assemblyline_v4_service.common.request import ServiceRequest
 from assemblyline_v4_service.common.result import (
     Heuristic,
     Result,
+    ResultGraphSection,
     ResultImageSection,
     ResultKeyValueSection,
     ResultMemoryDumpSection,
     ResultSection,
+    ResultTableSection,
+    TableRow,
 )
+from assemblyline_v4_service.common.task import MaxExtractedExceeded
+from assemblyline_v4_service.common.utils import extract_passwords
 from cairosvg import svg2png
 from multidecoder.decoders.network import find_emails, find_urls
 from PIL import Image as PILImage
-from PIL import ImageFile, ImageOps, UnidentifiedImageError
-from stegano import lsb
+from PIL import ImageFile, UnidentifiedImageError
 from wand.image import Image
 
-from pixaxe.helper import find_additional_content
-from pixaxe.steg import ImageInfo, NotSupported
+from pixaxe.bitplanes import find_bitstream_payloads
+from pixaxe.cache import PerceptualIndex, ResultCache, dump_section, load_section
+from pixaxe.carve import carve_payloads
+from pixaxe.helper import find_additional_content, image_end, steghide_capable
+from pixaxe.image import DecodedImage, dhash, hamming_distance, ocr_text, sample_frames
+from pixaxe.jpeg import dct_statistics, read_coefficients
+from pixaxe.qr import find_qr_codes, qr_greyscale
+from pixaxe.steg import ImageInfo, NotSupported, TimeBudgetExceeded, reveal_message
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# Short list of the passphrases most likely to be used, tried before the full wordlist
+STEGHIDE_WORDLIST = os.path.join(os.path.dirname(__file__), "steghide_wordlist.txt")
+ROCKYOU_WORDLIST = "/opt/al_service/rockyou.txt"
+
 
 class Pixaxe(ServiceBase):
     def __init__(self, config=None):
         super(Pixaxe, self).__init__(config)
+        self.cache = None
+        self.index = None
+        self.near_duplicate_threshold = -1
 
     def start(self):
         self.log.debug("Pixaxe service started")
+        if self.config.get("cache_directory"):
+            self.cache = ResultCache(
+                self.config["cache_directory"],
+                self.config.get("cache_max_size_mb", 256) * 1024 * 1024,
+                self.get_service_version(),
+            )
+            self.near_duplicate_threshold = self.config.get("near_duplicate_threshold", 8)
+            if self.near_duplicate_threshold >= 0:
+                self.index = PerceptualIndex(os.path.join(self.config["cache_directory"], "dhash_index.txt"))
+                if self.near_duplicate_threshold >= self.index.chunks:
+                    # The index only finds the hashes within fewer bits than it has chunks
+                    self.log.warning(
+                        f"near_duplicate_threshold of {self.near_duplicate_threshold} is too high, "
+                        f"using {self.index.chunks - 1} instead"
+                    )
+                    self.near_duplicate_threshold = self.index.chunks - 1
+
+    def _cached(self, request, analysis, params, analyse):
+        """
+        Run an analysis of the submitted image, unless its output was cached when the same image was seen before.
+        The analysis returns its output, which must be JSON serializable and not None, and whether it ran to
+        completion. Output cut short (ie. by a time budget) isn't cached, as the analysis could complete another time.
+        """
+        if self.cache is not None:
+            output = self.cache.get(request.sha256, analysis, params)
+            if output is not None:
+                return output
+        output, complete = analyse()
+        if self.cache is not None and complete:
+            self.cache.set(request.sha256, analysis, output, params)
+        return output
+
+    def _nearDuplicate(self, request, image):
+        """
+        Look for an image analysed before that looks the same as the submitted image, such as a re-encoded copy,
+        and add the submitted image to the index.
+
+        Returns:
+            The SHA-256 of the near-duplicate image and the distance between their hashes, or None.
+        """
+        fingerprint = dhash(image)
+        # Flat images (blank, or a single colour) all have nearly the same hash, whatever their content
+        if bin(fingerprint).count("1") < 16:
+            return None
+        nearest = self.index.nearest(fingerprint, self.near_duplicate_threshold, request.sha256)
+        self.index.add(fingerprint, request.sha256)
+        return nearest
 
     def tag_network_iocs(self, section: ResultSection, ocr_io: NamedTemporaryFile) -> None:
         ocr_io.seek(0)
@@ -43,88 +112,409 @@ class Pixaxe(ServiceBase):
         [section.add_tag("network.email.address", node.value) for node in find_emails(ocr_content.encode())]
         [section.add_tag("network.static.uri", node.value) for node in find_urls(ocr_content.encode())]
 
-    def _analyseGifImage(self, path):
+    def _compositeGifFrames(self, decoded: DecodedImage):
         """
-        Pre-process pass over the image to determine the mode (full or additive).
-        Necessary as assessing single frames isn't reliable. Need to know the mode
-        before processing all frames.
+        Decode the GIF frames in a single pass, compositing each one onto a canvas that is reused between frames.
+        Whether a frame replaces the canvas or updates part of it is decided from its own update region, so there
+        is no need for a pre-process pass over the image.
         """
-        im = PILImage.open(path)
-        results = {
-            "size": im.size,
-            "mode": "full",
-        }
-        try:
-            while True:
-                if im.tile:
-                    tile = im.tile[0]
-                    update_region = tile[1]
-                    update_region_dimensions = update_region[2:]
-                    if update_region_dimensions != im.size:
-                        results["mode"] = "partial"
-                        break
-                im.seek(im.tell() + 1)
-        except EOFError:
-            pass
-        return results
+        im = decoded.image
+        p = im.getpalette()
+        canvas = PILImage.new("RGBA", im.size)
+
+        for im in decoded.frames():
+            """
+            If the GIF uses local colour tables, each frame will have its own palette.
+            If not, we need to apply the global palette to the new frame.
+            """
+            if p is not None and not im.getpalette() and im.mode in ("L", "LA", "P", "PA"):
+                im.putpalette(p)
+
+            if canvas.size != im.size:
+                # Frames may extend past the logical screen, in which case the image grows to fit them
+                canvas, previous = PILImage.new("RGBA", im.size), canvas
+                canvas.paste(previous)
+
+            """
+            Does this frame update a region of a different size to the entire image?
+            If so, it is pasted on top of the preceding frames. Otherwise it is drawn on an empty canvas.
+            """
+            update_region = im.tile[0][1] if im.tile else (0, 0) + im.size
+            if update_region == (0, 0) + im.size:
+                canvas.paste((0, 0, 0, 0), (0, 0) + canvas.size)
+
+            frame = im.convert("RGBA")
+            canvas.paste(frame, (0, 0), frame)
+            yield canvas
+
+    def _addOcrSection(self, request, section, name, ocr_output, ocr_heuristic_id):
+        """
+        Report the OCR detections of an image whose text was extracted separately, as ResultImageSection.add_image
+        does when it runs the OCR itself.
+        """
+        ocr_results = detections(ocr_output)
+        if not ocr_results:
+            return
+
+        if ocr_results.get("password"):
+            # Add potential passwords to the submission's password list
+            passwords = set(request.temp_submission_data.get("passwords", []))
+            [passwords.update(extract_passwords(line)) for line in ocr_results["password"]]
+            request.temp_submission_data["passwords"] = sorted(passwords)
+
+        heuristic = Heuristic(ocr_heuristic_id, signatures={f"{k}_strings": len(v) for k, v in ocr_results.items()})
+        ocr_section = ResultKeyValueSection(f"Suspicious strings found during OCR analysis on file {name}")
+        ocr_section.set_heuristic(heuristic)
+        for k, v in ocr_results.items():
+            ocr_section.set_item(k, v)
+        section.add_subsection(ocr_section)
 
-    def _writeGifFrames(self, request, image_preview, ocr_heuristic_id, _handle_ocr_output):
+    def _writeGifFrames(self, request, decoded: DecodedImage, image_preview, ocr_heuristic_id, _handle_ocr_output):
         """
         Iterate the GIF, extracting each frame.
+        Frames that look the same as one that was already extracted are skipped, as they would only repeat the OCR.
+        Long animations are sampled down to max_ocr_frames frames, which are the only ones written out, and run
+        through OCR in parallel (in up to max_ocr_workers processes).
+
+        Returns:
+            A dictionary mapping the index of each skipped duplicate frame to the index of the frame it duplicates,
+            and the indices of the frames left out by sampling.
+        """
+        threshold = self.config.get("gif_frame_dedup_threshold", 8)
+        # -1 keeps every frame, as 0 falls back to the config
+        max_frames = request.get_param("max_ocr_frames") or self.config.get("max_ocr_frames", 20)
+        fingerprints = []
+        skipped = {}
+        changes = []
+        frame_paths = {}
+        # Copies of the frames kept, while there are few enough of them that none will be sampled out
+        held = {}
+
+        def _save(i, frame):
+            fh = NamedTemporaryFile(delete=False, suffix=".png")
+            frame.save(fh.name, "PNG")
+            fh.flush()
+            frame_paths[i] = fh.name
+
+        for i, frame in enumerate(self._compositeGifFrames(decoded)):
+            fingerprint = dhash(frame)
+            if threshold >= 0:
+                duplicate_of = next(
+                    (j for j, seen in fingerprints if hamming_distance(fingerprint, seen) <= threshold), None
+                )
+                if duplicate_of is not None:
+                    skipped[i] = duplicate_of
+                    continue
+            changes.append(hamming_distance(fingerprint, fingerprints[-1][1]) if fingerprints else 0)
+            fingerprints.append((i, fingerprint))
+            if max_frames <= 0:
+                # Every frame is kept
+                _save(i, frame)
+            elif len(fingerprints) <= max_frames:
+                held[i] = frame.copy()
+            else:
+                held.clear()
+
+        # Only the frames sampled are written out, which means decoding the frames again once some were sampled out
+        kept = [fingerprints[position][0] for position in sample_frames(changes, max_frames)]
+        unsampled = sorted(set(i for i, _ in fingerprints) - set(kept))
+        if held:
+            for i in kept:
+                _save(i, held.pop(i))
+        elif kept and not frame_paths:
+            wanted = set(kept)
+            for i, frame in enumerate(self._compositeGifFrames(decoded)):
+                if i in wanted:
+                    _save(i, frame)
+                if i == kept[-1]:
+                    break
+        sampled = [(i, frame_paths[i]) for i in kept]
+
+        def _ocr_frames():
+            paths = [path for _, path in sampled]
+            # Only the CPUs the service is allowed to run on (ie. its container's share) are counted
+            workers = min(self.config.get("max_ocr_workers", 1), len(os.sched_getaffinity(0)), len(paths))
+            try:
+                if workers > 1:
+                    try:
+                        with ProcessPoolExecutor(max_workers=workers) as pool:
+                            return list(pool.map(ocr_text, paths)), True
+                    except (BrokenProcessPool, OSError) as e:
+                        # Workers couldn't be started, or were killed (ie. out of memory), so OCR is run in process
+                        self.log.warning(f"OCR process pool failed, running OCR in process: {e}")
+                return [ocr_text(path) for path in paths], True
+            except ImportError as e:
+                # No text was read, which isn't the text of the frames
+                self.log.warning(str(e))
+                return [""] * len(sampled), False
+
+        ocr_outputs = [""] * len(sampled)
+        if ocr_heuristic_id and sampled:
+            # Which frames are sampled depends on the deduplication threshold and number of frames
+            ocr_outputs = self._cached(request, "gif_ocr", [threshold, max_frames], _ocr_frames)
+
+        # Results are added in frame order, whichever order the OCR finished in
+        for (i, path), ocr_output in zip(sampled, ocr_outputs):
+            name = f"{request.file_name}_frame_{i}"
+            ocr_io = NamedTemporaryFile("w+", delete=False)
+            ocr_io.write(ocr_output)
+            ocr_io.flush()
+
+            image_preview.add_image(path, name=name, description="GIF frame")
+            if ocr_heuristic_id:
+                self._addOcrSection(request, image_preview, name, ocr_output, ocr_heuristic_id)
+            # Tag any network IOCs found in OCR output
+            self.tag_network_iocs(image_preview, ocr_io)
+
+            _handle_ocr_output(ocr_io, fn_prefix=name)
+
+        return skipped, unsampled
+
+    def _extractPayloads(self, request, result, decoded: DecodedImage, appended_size):
+        """
+        Carve the payloads out of the content appended to the image (or anywhere in the file on deep scans)
+        and extract each of them, so chained payloads are analysed separately.
         """
-        mode = self._analyseGifImage(request.file_path)["mode"]
+        contents = decoded.contents
+        end = image_end(contents)
+        if request.deep_scan:
+            # Skip the signature of the image itself
+            start = 1
+        elif end is not None and appended_size:
+            start = end
+        else:
+            return
 
-        im = PILImage.open(request.file_path)
+        payloads = carve_payloads(contents, start)
+        if end is not None and appended_size:
+            # A single payload making up all of the appended content has already been extracted as a whole
+            payloads = [p for p in payloads if not (p.offset == end and p.end >= end + appended_size)]
+        if not payloads:
+            return
 
-        i = 0
-        p = im.getpalette()
-        last_frame = im.convert("RGBA")
+        carved_section = ResultTableSection("Carved Payloads", parent=result)
+        for payload in payloads:
+            with memoryview(contents)[payload.offset : payload.end] as payload_data:
+                file_name = f"{hashlib.sha256(payload_data).hexdigest()[0:10]}_carved_{payload.offset}"
+                file_path = os.path.join(self.working_directory, file_name)
+                with open(file_path, "wb") as payload_file:
+                    payload_file.write(payload_data)
+            carved_section.add_row(TableRow(offset=payload.offset, size=payload.size, type=payload.file_type))
+            try:
+                request.add_extracted(
+                    file_path,
+                    file_name,
+                    f"Carved {payload.file_type} content found at offset {payload.offset}.",
+                    safelist_interface=self.api_interface,
+                )
+            except MaxExtractedExceeded:
+                self.log.warning("Maximum number of extracted files reached, not all carved payloads were extracted.")
+                break
 
-        try:
-            while True:
-                """
-                If the GIF uses local colour tables, each frame will have its own palette.
-                If not, we need to apply the global palette to the new frame.
-                """
-                if p is not None and not im.getpalette() and im.mode in ("L", "LA", "P", "PA"):
-                    im.putpalette(p)
-
-                new_frame = PILImage.new("RGBA", im.size)
-
-                """
-                Is this file a "partial"-mode GIF where frames update a region of a different size to the entire image?
-                If so, we need to construct the new frame by pasting it on top of the preceding frames.
-                """
-                if mode == "partial":
-                    new_frame.paste(last_frame)
-
-                new_frame.paste(im, (0, 0), im.convert("RGBA"))
-                fh = NamedTemporaryFile(delete=False, suffix=".png")
-                new_frame.save(fh.name, "PNG")
-                fh.flush()
+    def _runStegseek(self, request):
+        """Crack the steghide passphrase of the image, trying the likeliest passphrases first.
 
-                ocr_io = NamedTemporaryFile("w+", delete=False)
+        The passwords known for the submission and the curated wordlist are tried first, and the full rockyou
+        wordlist only on deep scans. Every attempt shares the same time budget, and stegseek stops at the first
+        passphrase that works.
+
+        Args:
+            request: AL request object.
 
-                image_preview.add_image(
-                    fh.name,
-                    name=f"{request.file_name}_frame_{i}",
-                    description="GIF frame",
-                    ocr_heuristic_id=ocr_heuristic_id,
-                    ocr_io=ocr_io,
+        Returns:
+            The path of the extracted file and the output of stegseek for the attempt that extracted it, or None.
+        """
+        extract_path = os.path.join(self.working_directory, "stegseek_extract")
+        passwords = request.temp_submission_data.get("passwords", [])
+        params = [request.deep_scan, passwords, self.config.get("stegseek_time_budget", 10)]
+        cached = self.cache.get(request.sha256, "stegseek", params) if self.cache else None
+        if cached is not None:
+            if not cached["output"]:
+                return None
+            with open(extract_path, "wb") as f:
+                f.write(base64.b64decode(cached["extracted"]))
+            return extract_path, cached["output"].encode()
+
+        output = self._crackSteghide(request, passwords, extract_path)
+        if self.cache:
+            extracted = None
+            if output:
+                with open(extract_path, "rb") as f:
+                    extracted = base64.b64encode(f.read()).decode()
+            self.cache.set(
+                request.sha256, "stegseek", {"output": safe_str(output or b""), "extracted": extracted}, params
+            )
+        return (extract_path, output) if output else None
+
+    def _crackSteghide(self, request, passwords, extract_path):
+        """Run stegseek with each wordlist in turn, returning its output once it extracted a file, or None."""
+        wordlist = os.path.join(self.working_directory, "stegseek_wordlist.txt")
+        with open(wordlist, "w") as f:
+            for password in passwords:
+                f.write(f"{password}\n")
+            with open(STEGHIDE_WORDLIST) as curated:
+                f.write(curated.read())
+        wordlists = [wordlist]
+        if request.deep_scan:
+            wordlists.append(ROCKYOU_WORDLIST)
+
+        deadline = time.monotonic() + self.config.get("stegseek_time_budget", 10)
+        for wordlist in wordlists:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                output = subprocess.run(
+                    ["stegseek", "-a", "-f", request.file_path, wordlist, extract_path],
+                    capture_output=True,
+                    timeout=remaining,
+                ).stderr
+            except subprocess.TimeoutExpired:
+                self.log.info("Time budget for stegseek expired, passphrase not found.")
+                break
+            if b"Extracting to" in output:
+                return output
+        return None
+
+    def _decloak(self, request, img_info: ImageInfo, steg_section, deadline):
+        """
+        Run the steganography modules on the image until the deadline, unless their results were cached when the same
+        image was seen before, in which case the sections and supplementary images are restored from the cache.
+        """
+        time_budget = self.config.get("steg_time_budget", 10)
+        # The size of the image analysed tells whether it was sampled, and how
+        params = [img_info.analysed_size, time_budget]
+        cached = self.cache.get(request.sha256, "decloak", params) if self.cache else None
+        if cached is None:
+            img_info.decloak(max(deadline - time.monotonic(), 0))
+            if not self.cache or img_info.skipped_modules:
+                # Modules cut short by the time budget could complete another time, so partial results aren't kept
+                return
+            cached = {"section": None, "supplementary": []}
+            if img_info.working_result in steg_section.subsections:
+                cached["section"] = dump_section(img_info.working_result)
+            for file_path, name, description in img_info.supplementary_files:
+                with open(file_path, "rb") as f:
+                    data = base64.b64encode(f.read()).decode()
+                cached["supplementary"].append([os.path.basename(file_path), name, description, data])
+            self.cache.set(request.sha256, "decloak", cached, params)
+            return
+
+        for file_name, name, description, data in cached["supplementary"]:
+            file_path = os.path.join(self.working_directory, file_name)
+            with open(file_path, "wb") as f:
+                f.write(base64.b64decode(data))
+            request.add_supplementary(file_path, name, description)
+        if cached["section"]:
+            steg_section.add_subsection(load_section(cached["section"]))
+
+    def _dctSteganalysis(self, request, decoded: DecodedImage, steg_section):
+        """
+        Run the coefficient histogram tests on the quantised DCT coefficients of a JPEG image, which is where JSteg,
+        F5 and OutGuess hide data. libjpeg reads the coefficients without decoding the pixels.
+        """
+
+        def _analyse():
+            coefficients = read_coefficients(decoded.path)
+            return (dct_statistics(coefficients) if coefficients else {}), True
+
+        stats = self._cached(request, "dct", None, _analyse)
+        if not stats:
+            return
+
+        section = ResultKeyValueSection("JPEG DCT Coefficient Analysis", parent=steg_section)
+        section.set_item("blocks", stats["blocks"])
+        section.set_item("non_zero_ac_coefficients", stats["non_zero_ac"])
+        section.set_item("zero_ac_fraction", round(stats["zero_ac_fraction"], 4))
+        p_values = stats["pair_of_values"]
+        if p_values:
+            section.set_item("pair_of_values_p_value", round(p_values[-1], 4))
+            graph = ResultGraphSection(
+                "Pair of values p-value over the first 5%, 10%... of the coefficients. 0==Not embedded, 100==Embedded",
+                parent=section,
+            )
+            graph.set_colormap(0, 100, [p * 100 for p in p_values])
+
+            # Sequential embedding (as JSteg does) evens out the pairs of values from the first coefficient on, up to
+            # the end of the message. Below a thousand coefficients, the test is too weak to go by.
+            embedded = next((i for i, p in enumerate(p_values) if p < 0.05), len(p_values))
+            if embedded and stats["usable_ac"] / len(p_values) >= 1000:
+                fraction = embedded / len(p_values)
+                pov = ResultSection("DCT coefficients show signs of LSB embedding (JSteg, OutGuess)", parent=section)
+                pov.add_line(
+                    f"Pairs of values are even over the first {fraction:.0%} of the coefficients, "
+                    f"about {int(stats['usable_ac'] * fraction / 8)} bytes of possible embedded data."
                 )
-                # Tag any network IOCs found in OCR output
-                self.tag_network_iocs(image_preview, ocr_io)
+                pov.set_heuristic(2)
 
-                _handle_ocr_output(ocr_io, fn_prefix=f"{request.file_name}_frame_{i}")
+        if stats["f5_encoder"]:
+            f5 = ResultSection("Image written by the F5 steganography encoder", parent=section)
+            f5.add_line("The JPEG encoder comment of the F5 steganography tool was found in the image.")
+            f5.set_heuristic(2)
 
-                i += 1
-                last_frame = new_frame
-                im.seek(im.tell() + 1)
-        except EOFError:
-            pass
+    def _extractBitstreams(self, request, decoded: DecodedImage, steg_section, deadline):
+        """
+        Read the low bit planes of the image in every channel, bit and scan order, and report the bitstreams that
+        start with a file or with text, as other LSB tools than stegano would hide them. Files are extracted, text is
+        only shown in the table. Only files are scored, as natural images often have a bit plane that reads as text.
+        """
+        cached = self.cache.get(request.sha256, "bitstreams") if self.cache else None
+        if cached is None:
+            cached = []
+            try:
+                for payload in find_bitstream_payloads(decoded, deadline=deadline):
+                    cached.append([payload.config.name, payload.file_type, base64.b64encode(payload.data).decode()])
+            except TimeBudgetExceeded:
+                # The configurations left might hold more, so what was found isn't cached
+                self.log.info("Steganography time budget exceeded, not every bitstream was searched.")
+            else:
+                if self.cache:
+                    self.cache.set(request.sha256, "bitstreams", cached)
+
+        bitstream_section = ResultTableSection("Payloads found in the bit planes")
+        files_found = False
+        for config_name, file_type, data in cached:
+            data = base64.b64decode(data)
+            # Messages hidden by stegano are read (and reported) by reveal_message()
+            if config_name == "bit0,rgb,msb,xy" and file_type == "text" and re.match(rb"\d+:", data):
+                continue
+            bitstream_section.add_row(
+                TableRow(configuration=config_name, size=len(data), type=file_type, preview=safe_str(data[:100]))
+            )
+            if file_type == "text":
+                continue
+            files_found = True
+            file_name = f"{hashlib.sha256(data).hexdigest()[0:10]}_{config_name.replace(',', '_')}"
+            file_path = os.path.join(self.working_directory, file_name)
+            with open(file_path, "wb") as payload_file:
+                payload_file.write(data)
+            try:
+                request.add_extracted(
+                    file_path,
+                    file_name,
+                    f"{file_type} content found in the bit planes of the image ({config_name}).",
+                    safelist_interface=self.api_interface,
+                )
+            except MaxExtractedExceeded:
+                self.log.warning("Maximum number of extracted files reached, not all bitstreams were extracted.")
+                break
+        if bitstream_section.body:
+            if files_found:
+                bitstream_section.set_heuristic(2)
+            steg_section.add_subsection(bitstream_section)
 
     def execute(self, request: ServiceRequest):
         """Main Module. See README for details."""
+        # The submitted image is decoded at most once and shared by every stage of the analysis
+        with DecodedImage(request.file_path) as decoded, ThreadPoolExecutor(max_workers=1) as stegseek_pool:
+            # stegseek only needs the submitted file, so it runs in the background while the image is analysed.
+            # Steghide can only hide data in some formats, don't bother cracking anything else.
+            stegseek = None
+            if steghide_capable(decoded.contents[:18]):
+                stegseek = stegseek_pool.submit(self._runStegseek, request)
+            self._execute(request, decoded, stegseek)
+
+    def _execute(self, request: ServiceRequest, decoded: DecodedImage, stegseek: Optional[Future]):
         result = Result()
         displayable_image_path = request.file_path
         pillow_incompatible = False
@@ -158,7 +548,7 @@ class Pixaxe(ServiceBase):
                     Image(filename=request.file_path).save(filename=displayable_image_path)
                 elif request.file_type.endswith("svg"):
                     # PIL doesn't support SVG so we will need to convert
-                    svg2png(bytestring=request.file_contents, write_to=displayable_image_path)
+                    svg2png(bytestring=decoded.contents[:], write_to=displayable_image_path)
 
                 pillow_incompatible = True
             except Exception:
@@ -169,43 +559,86 @@ class Pixaxe(ServiceBase):
         try:
             # Always provide a preview of the image being analyzed
             image_preview = ResultImageSection(request, "Image Preview")
+            skipped_frames, unsampled_frames = {}, []
+            near_duplicate = None
             ocr_heuristic_id = 1 if not request.file_type == "image/bmp" else None
             if request.file_type == "image/gif":
                 # Render all frames in the GIF and append to results
-                self._writeGifFrames(request, image_preview, ocr_heuristic_id, _handle_ocr_output)
+                skipped_frames, unsampled_frames = self._writeGifFrames(
+                    request, decoded, image_preview, ocr_heuristic_id, _handle_ocr_output
+                )
 
             else:
                 ocr_io = NamedTemporaryFile("w+", delete=False)
-                image_preview.add_image(
-                    displayable_image_path,
-                    name=request.file_name,
-                    description="Input file",
-                    ocr_heuristic_id=ocr_heuristic_id,
-                    ocr_io=ocr_io,
-                )
+                ocr_output = None
+                if ocr_heuristic_id and self.cache:
+                    ocr_output = self.cache.get(request.sha256, "ocr")
+                    if ocr_output is None and self.index is not None:
+                        # Near-duplicates of an image seen before, like re-encoded lures, reuse its text. QR codes
+                        # are always decoded, as a code swapped for another barely changes the look of the image.
+                        if displayable_image_path == request.file_path:
+                            near_duplicate = self._nearDuplicate(request, decoded.image)
+                        else:
+                            with PILImage.open(displayable_image_path) as converted:
+                                near_duplicate = self._nearDuplicate(request, converted)
+                        if near_duplicate:
+                            ocr_output = self.cache.get(near_duplicate[0], "ocr")
+                            if ocr_output is not None:
+                                self.cache.set(request.sha256, "ocr", ocr_output)
+                if ocr_output is None:
+                    image_preview.add_image(
+                        displayable_image_path,
+                        name=request.file_name,
+                        description="Input file",
+                        ocr_heuristic_id=ocr_heuristic_id,
+                        ocr_io=ocr_io,
+                    )
+                    if ocr_heuristic_id and self.cache:
+                        ocr_io.seek(0)
+                        self.cache.set(request.sha256, "ocr", ocr_io.read())
+                else:
+                    # The text of the image is already known, only the OCR detections need to be reported
+                    image_preview.add_image(displayable_image_path, name=request.file_name, description="Input file")
+                    ocr_io.write(ocr_output)
+                    ocr_io.flush()
+                    self._addOcrSection(request, image_preview, request.file_name, ocr_output, ocr_heuristic_id)
                 # Tag any network IOCs found in OCR output
                 self.tag_network_iocs(image_preview, ocr_io)
 
                 _handle_ocr_output(ocr_io, fn_prefix=request.file_name)
             image_preview.promote_as_screenshot()
             result.add_section(image_preview)
+            if skipped_frames:
+                skipped_section = ResultKeyValueSection("Duplicate GIF frames skipped", parent=result)
+                for frame, duplicate_of in skipped_frames.items():
+                    skipped_section.set_item(f"frame_{frame}", f"frame_{duplicate_of}")
+            if unsampled_frames:
+                unsampled_section = ResultKeyValueSection("GIF frames skipped by frame sampling", parent=result)
+                unsampled_section.set_item("skipped_frames", [f"frame_{frame}" for frame in unsampled_frames])
+            if near_duplicate:
+                similar, distance = near_duplicate
+                duplicate_section = ResultKeyValueSection("Near-duplicate of an image analysed before", parent=result)
+                duplicate_section.set_item("sha256", similar)
+                duplicate_section.set_item("hash_distance", distance)
+                duplicate_section.set_item("ocr_text_reused", ocr_output is not None)
 
             # Attempt QR code decoding
             qr_detected_section: Optional[ResultSection] = None
-            qr_results = subprocess.run(["zbarimg", "-q", displayable_image_path], capture_output=True).stdout.decode()
-            if not qr_results:
-                # Try decoding with a color invert of the image
-                with NamedTemporaryFile() as tmp_qr:
-                    ImageOps.invert(PILImage.open(request.file_path).convert("RGB")).save(tmp_qr.name, format="JPEG")
-                    qr_results = subprocess.run(["zbarimg", "-q", tmp_qr.name], capture_output=True).stdout.decode()
 
-            if qr_results:
-                for i, qr_result in enumerate(qr_results.split("\n")):
-                    code_type, code_value = qr_result.split(":", 1)
-                    if not code_type == "QR-Code":
-                        # Non-QR code found, skip
-                        continue
+            def _decode_qr_codes():
+                if displayable_image_path == request.file_path:
+                    qr_image = qr_greyscale(decoded.image)
+                else:
+                    with PILImage.open(displayable_image_path) as converted:
+                        qr_image = qr_greyscale(converted)
+                return find_qr_codes(qr_image, qr_time_budget)
 
+            qr_time_budget = self.config.get("qr_time_budget", 5)
+            qr_results = self._cached(request, "qr", [qr_time_budget], _decode_qr_codes)
+
+            code_type = "QR-Code"
+            if qr_results:
+                for i, code_value in enumerate(qr_results):
                     if not qr_detected_section:
                         qr_heur = Heuristic(3)
                         qr_detected_section = ResultSection(qr_heur.name, heuristic=qr_heur, parent=result)
@@ -232,14 +665,10 @@ class Pixaxe(ServiceBase):
                 pillow_incompatible = True
 
         steg_section = ResultMemoryDumpSection("Steganographical Analysis")
-        # Attempt to extract files from the image
-        extract_path = NamedTemporaryFile(delete=False)
-        p = subprocess.run(
-            ["stegseek", "-a", "-f", request.file_path, "/opt/al_service/rockyou.txt", extract_path.name],
-            capture_output=True,
-        ).stderr
-
-        if b"Extracting to" in p:
+        # Collect any file stegseek extracted from the image in the background
+        stegseek_result = stegseek.result() if stegseek else None
+        if stegseek_result:
+            extract_path, p = stegseek_result
             self.log.info("Embedded file extracted from image.")
             extracted_section = ResultKeyValueSection("Secret file was extracted from image", parent=steg_section)
             lines = [x for x in p.decode().splitlines() if "e: " in x]
@@ -255,7 +684,7 @@ class Pixaxe(ServiceBase):
             if passphrase is not None:
                 extracted_section.set_item("passphrase", passphrase)
             request.add_extracted(
-                extract_path.name, orig_name, "File extracted from image", safelist_interface=self.api_interface
+                extract_path, orig_name, "File extracted from image", safelist_interface=self.api_interface
             )
             extracted_section.set_heuristic(2)
 
@@ -265,15 +694,11 @@ class Pixaxe(ServiceBase):
             return
 
         secret_msg = None
-        if "RGB" not in PILImage.open(request.file_path).mode:
-            # Library expects an image containing RGB channels
+        if "RGB" not in decoded.mode:
+            # Stegano only hides messages in images with RGB channels
             secret_msg = None
         elif not request.file_type.endswith("jpg") or request.deep_scan:
-            try:
-                secret_msg = lsb.reveal(request.file_path)
-            except IndexError:
-                # Unable to determine a secret message
-                pass
+            secret_msg = reveal_message(decoded)
         # Think it's unlikely to have both a hidden message and an embedded file
         if secret_msg:
             self.log.info("Secret message found.")
@@ -283,35 +708,46 @@ class Pixaxe(ServiceBase):
         # Default to original behaviour
         else:
             # Find attached data
-            additional_content = find_additional_content(request.file_contents)
+            additional_content = find_additional_content(decoded.contents)
+            appended_size = len(additional_content) if additional_content else 0
             if additional_content:
                 ares = ResultMemoryDumpSection("Possible Appended Content Found")
-                ares.add_line("{} Bytes of content found at end of image file".format(len(additional_content)))
+                ares.add_line("{} Bytes of content found at end of image file".format(appended_size))
                 ares.add_line("Text preview (up to 500 bytes):\n")
-                ares.add_line("{}".format(safe_str(additional_content)[0:500]))
+                ares.add_line("{}".format(safe_str(additional_content[0:2000].tobytes())[0:500]))
                 ares.set_heuristic(2)
                 result.add_section(ares)
                 file_name = "{}_appended_img_content".format(hashlib.sha256(additional_content).hexdigest()[0:10])
                 file_path = os.path.join(self.working_directory, file_name)
                 with open(file_path, "wb") as unibu_file:
                     unibu_file.write(additional_content)
+                # Let go of the view on the file's memory map so that it can be closed
+                additional_content.release()
                 request.add_extracted(
                     file_path, file_name, "Carved content found at end of image.", safelist_interface=self.api_interface
                 )
 
-        # Steganography modules
-        try:
-            img_info = ImageInfo(request.file_path, request, steg_section, self.working_directory, self.log)
-            self.log.debug(f"Pixel Count: {img_info.pixel_count}")
-            if (
-                img_info.pixel_count > 100
-                and img_info.pixel_count < self.config.get("max_pixel_count", 100000)
-                or request.deep_scan
-            ):
-                img_info.decloak()
-
-            if steg_section.body or steg_section.subsections:
-                result.add_section(steg_section)
-        except NotSupported:
-            pass
+            self._extractPayloads(request, result, decoded, appended_size)
+
+        if request.file_type.endswith("jpg"):
+            self._dctSteganalysis(request, decoded, steg_section)
+
+        # Steganography modules. Pixel LSBs don't survive JPEG compression, so JPEGs only go through them on deep scans.
+        if not request.file_type.endswith("jpg") or request.deep_scan:
+            # The bit planes and the modules share the time budget
+            deadline = time.monotonic() + self.config.get("steg_time_budget", 10)
+            self._extractBitstreams(request, decoded, steg_section, deadline)
+            try:
+                img_info = ImageInfo(decoded, request, steg_section, self.working_directory, self.log)
+                self.log.debug(f"Pixel Count: {img_info.pixel_count}")
+                if img_info.pixel_count > 100 or request.deep_scan:
+                    if not request.deep_scan:
+                        # Large images are analysed on a sample of their rows, deep scans analyse every pixel
+                        img_info.sample(self.config.get("max_pixel_count", 100000))
+                    self._decloak(request, img_info, steg_section, deadline)
+            except NotSupported:
+                pass
+
+        if steg_section.body or steg_section.subsections:
+            result.add_section(steg_section)
         request.result = result
@@ -0,0 +1,251 @@
+import time
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def qr_greyscale(image: Image.Image) -> np.ndarray:
+    """Greyscale copy of an image to look for QR codes in, with any transparency flattened onto white.
+
+    Args:
+        image: Pillow image.
+
+    Returns:
+        The greyscale pixel data, shaped (height, width).
+    """
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        flattened = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        flattened.alpha_composite(image.convert("RGBA"))
+        image = flattened
+    return np.asarray(image.convert("L"))
+
+
+def decode_qr_codes(greyscale: np.ndarray) -> List[str]:
+    """Decode the QR codes found in an image.
+
+    Args:
+        greyscale: Greyscale pixel data, shaped (height, width).
+
+    Returns:
+        The content of each QR code that could be decoded.
+    """
+    detector = cv2.QRCodeDetector()
+    found, values, _, _ = detector.detectAndDecodeMulti(greyscale)
+    if found and any(values):
+        return [value for value in values if value]
+
+    # Detecting several codes at once can miss a code that is found on its own
+    value, _, _ = detector.detectAndDecode(greyscale)
+    return [value] if value else []
+
+
+def _finder_runs(dark: np.ndarray, step: int) -> np.ndarray:
+    """Find the runs of pixels along rows that cross a finder pattern.
+
+    Through its centre, a finder pattern is a dark, light, dark, light, dark sequence of runs in the
+    proportions 1:1:3:1:1 (or the reverse colours for an inverted code).
+
+    Args:
+        dark: Whether each pixel is dark, shaped (height, width).
+        step: Only every step rows are scanned.
+
+    Returns:
+        The row, centre column, width and colour (1 for a light pattern) of each match, shaped (matches, 4).
+    """
+    dark = dark[::step]
+    width = dark.shape[1]
+    starts = np.ones_like(dark)
+    starts[:, 1:] = dark[:, 1:] != dark[:, :-1]
+    offsets = np.flatnonzero(starts)
+    lengths = np.diff(np.append(offsets, dark.size)).astype(np.float32)
+    rows = offsets // width
+
+    # Windows of five consecutive runs within a row
+    first = np.flatnonzero(rows[:-4] == rows[4:])
+    runs = np.stack([lengths[first + k] for k in range(5)], axis=1)
+    module = runs.sum(axis=1) / 7
+    expected = module[:, None] * np.array([1, 1, 3, 1, 1], dtype=np.float32)
+    matches = np.all(np.abs(runs - expected) < module[:, None] * np.array([0.5, 0.5, 1.5, 0.5, 0.5]), axis=1)
+    # Codes with modules under 2 pixels wide can't be decoded anyway
+    matches &= module >= 2
+    first, runs, module = first[matches], runs[matches], module[matches]
+    centres = offsets[first + 2] % width + runs[:, 2] / 2
+    light = ~dark.flat[offsets[first]]
+    return np.stack([rows[first] * step, centres, module * 7, light], axis=1)
+
+
+def finder_patterns(greyscale: np.ndarray, max_side: int = 4096) -> List[Tuple[int, int, int, int]]:
+    """Look for the finder patterns that mark the corners of QR codes.
+
+    Rows and columns are scanned for the 1:1:3:1:1 sequence of runs that crosses the centre of a finder pattern,
+    and a pattern is found wherever a match along a row and one along a column share their centre.
+
+    Args:
+        greyscale: Greyscale pixel data, shaped (height, width).
+        max_side: Larger images are downscaled to this size first.
+
+    Returns:
+        The bounding box (x, y, width, height) of each finder pattern, in the coordinates of greyscale.
+    """
+    scale = min(1.0, max_side / max(greyscale.shape))
+    if scale < 1.0:
+        greyscale = cv2.resize(greyscale, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, binary = cv2.threshold(greyscale, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    dark = binary == 0
+
+    # The centre of a finder pattern is at least 6 pixels high and wide, so every other row and column is enough
+    horizontal = _finder_runs(dark, 2)
+    if not len(horizontal):
+        return []
+    vertical = _finder_runs(np.ascontiguousarray(dark.T), 2)
+
+    # Index the column matches by the cell they fall in, to pair them up with the row matches
+    cell = max(int(np.median(horizontal[:, 2])) // 2, 1)
+    columns = {}
+    for x, y, size, light in vertical:
+        columns.setdefault((int(y) // cell, int(x) // cell), []).append((y, x, size, light))
+
+    patterns = []
+    found = set()
+    for y, x, size, light in horizontal:
+        cell_y, cell_x = int(y) // cell, int(x) // cell
+        for other_y, other_x, other_size, other_light in (
+            match for dy in (-1, 0, 1) for dx in (-1, 0, 1) for match in columns.get((cell_y + dy, cell_x + dx), ())
+        ):
+            if (
+                other_light == light
+                and abs(other_y - y) < size / 4
+                and abs(other_x - x) < size / 4
+                and 0.67 < other_size / size < 1.5
+            ):
+                # The row match gives the centre column, and the column match the centre row. Several rows and
+                # columns cross the same pattern, only keep one of them.
+                key = (int(x) // max(int(size) // 2, 1), int(other_y) // max(int(size) // 2, 1))
+                if key not in found:
+                    found.add(key)
+                    box = (x - size / 2, other_y - size / 2, size, size)
+                    patterns.append(tuple(int(round(v / scale)) for v in box))
+                break
+    return patterns
+
+
+def qr_regions(
+    patterns: List[Tuple[int, int, int, int]], shape: Tuple[int, int], max_regions: int = 16
+) -> List[Tuple[int, int, int, int]]:
+    """Locate the regions of an image that could hold a QR code, from its finder patterns.
+
+    The three finder patterns of a QR code have the same size and sit on the corners of a right isosceles
+    triangle, with sides between 2 and 25 times their size (the smallest and largest QR codes).
+
+    Args:
+        patterns: Bounding boxes of the finder patterns found in the image.
+        shape: Height and width of the image.
+        max_regions: Stop looking once this many regions are found.
+
+    Returns:
+        The bounding box (x, y, width, height) of each candidate region, with room for the quiet zone around it.
+    """
+    if len(patterns) < 3:
+        return []
+    boxes = np.array(patterns, dtype=np.float64)
+    sizes = boxes[:, 2]
+    centres = boxes[:, :2] + boxes[:, 2:] / 2
+    distances = np.linalg.norm(centres[:, None] - centres[None], axis=-1)
+    ratios = sizes[None] / sizes[:, None]
+    neighbours = (ratios > 0.67) & (ratios < 1.5)
+    neighbours &= (distances > 1.5 * sizes[:, None]) & (distances < 25 * sizes[:, None])
+
+    regions = []
+    for corner in range(len(patterns)):
+        others = np.flatnonzero(neighbours[corner])
+        if len(others) < 2:
+            continue
+        sides = centres[others] - centres[corner]
+        lengths = distances[corner, others]
+        cosines = (sides @ sides.T) / np.outer(lengths, lengths)
+        similar = np.abs(lengths[:, None] - lengths[None]) < 0.2 * np.maximum(lengths[:, None], lengths[None])
+        for first, second in zip(*np.nonzero(np.triu((np.abs(cosines) < 0.2) & similar))):
+            # The fourth corner of the code is opposite the corner pattern
+            corners = centres[[corner, others[first], others[second]]]
+            corners = np.vstack([corners, corners[1] + corners[2] - corners[0]])
+            margin = 1.2 * sizes[corner]
+            x0, y0 = np.maximum(corners.min(axis=0) - margin, 0)
+            x1, y1 = np.minimum(corners.max(axis=0) + margin, (shape[1], shape[0]))
+            region = (int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+            # Patterns found more than once give the same region several times over
+            if not any(_overlap(region, other) > 0.5 for other in regions):
+                regions.append(region)
+                if len(regions) == max_regions:
+                    return regions
+    return regions
+
+
+def _overlap(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    """Area of the intersection of two boxes, as a fraction of the smallest of them."""
+    width = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    height = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    return width * height / max(min(a[2] * a[3], b[2] * b[3]), 1)
+
+
+def find_qr_codes(greyscale: np.ndarray, time_budget: float = 5.0, min_side: int = 512) -> Tuple[List[str], bool]:
+    """Find and decode the QR codes in an image.
+
+    Most images don't hold a QR code, so nothing is decoded unless finder patterns are laid out like one. The
+    candidate regions are then decoded at full resolution, which is quick and finds small codes in large images.
+    If that fails, the whole image is decoded at increasing scales, up to its full size. Each decode is also tried
+    on the inverted image. The time budget covers the whole search, and a scale is skipped when decoding it isn't
+    expected to finish within the budget.
+
+    Args:
+        greyscale: Greyscale pixel data, shaped (height, width).
+        time_budget: Seconds to spend decoding before giving up on the remaining regions and scales.
+        min_side: Size of the smallest scale the whole image is decoded at.
+
+    Returns:
+        The content of each QR code that could be decoded, and whether the search was completed within the time
+        budget.
+    """
+    deadline = time.monotonic() + time_budget
+    regions = qr_regions(finder_patterns(greyscale), greyscale.shape)
+    if not regions:
+        return [], True
+
+    results = []
+    complete = True
+    for x, y, w, h in regions:
+        if time.monotonic() > deadline:
+            complete = False
+            break
+        crop = np.ascontiguousarray(greyscale[y : y + h, x : x + w])
+        # Decoders need the quiet zone around the code, which may have been cut off at the edge of the image
+        crop = cv2.copyMakeBorder(crop, 16, 16, 16, 16, cv2.BORDER_REPLICATE)
+        for value in decode_qr_codes(crop) or decode_qr_codes(255 - crop):
+            if value not in results:
+                results.append(value)
+    if results:
+        return results, complete
+
+    scale = min(1.0, min_side / max(greyscale.shape))
+    elapsed = 0.0
+    while True:
+        # Decoding time grows at least with the number of pixels, which doubling the scale multiplies by 4
+        if time.monotonic() + 4 * elapsed > deadline:
+            complete = False
+            break
+        started = time.monotonic()
+        image = greyscale
+        if scale < 1.0:
+            image = cv2.resize(greyscale, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        results = decode_qr_codes(image)
+        if not results:
+            # Try decoding with a color invert of the image
+            results = decode_qr_codes(255 - image)
+        if results or scale >= 1.0:
+            break
+        elapsed = time.monotonic() - started
+        scale = min(1.0, scale * 2)
+    return results, complete
@@ -3,7 +3,9 @@ Requires numpy, Pillow(PIL), python-matplotlib, scipy
 """
 
 import math
+import time
 from os import path
+from typing import Optional
 
 import cv2
 import matplotlib.pyplot as plt
@@ -11,24 +13,73 @@ import numpy as np
 from assemblyline_v4_service.common.result import (
     ResultGraphSection,
     ResultJSONSection,
+    ResultKeyValueSection,
     ResultMemoryDumpSection,
     ResultSection,
 )
 from PIL import Image
 from scipy.stats import chisquare
 
+from pixaxe.image import DecodedImage
+
 
 class NotSupported(Exception):
     pass
 
 
+class TimeBudgetExceeded(Exception):
+    """Raised by ImageInfo.strips() when the time budget of decloak() runs out part way through a module."""
+
+
+def reveal_message(decoded: DecodedImage) -> Optional[str]:
+    """Find a message hidden with stegano's LSB technique (stegano.lsb.hide).
+
+    Stegano hides the message in the LSB of each colour value (leaving out the alpha channel of RGBA images), pixel by
+    pixel along the rows, as 8 bit characters prefixed by the length of the message and a colon. The length is read
+    first, from the first few pixels, and the message is only pulled out when the length is plausible, so images
+    without a message are turned down without going through their pixels.
+
+    Args:
+        decoded: Image to search, in one of the RGB modes.
+
+    Returns:
+        The message, or None if the image doesn't hold one.
+    """
+    width, height = decoded.size
+    bands = len(decoded.image.getbands())
+    channels = 3 if decoded.mode == "RGBA" else bands
+    capacity = width * height * channels // 8
+
+    def _characters(count):
+        # LSB of the colour values of as many rows as the characters need, packed into bytes
+        bits = count * 8
+        rows = min(math.ceil(bits / (width * channels)), height)
+        values = np.asarray(decoded.rows(0, rows)).reshape(-1, bands)[:, :channels]
+        return np.packbits(values.ravel()[:bits] & 1).tobytes()
+
+    # The length can't have more digits than the number of characters the image can hold
+    header = _characters(min(len(str(capacity)) + 1, capacity))
+    digits, colon, _ = header.partition(b":")
+    if not colon or not digits.isdigit() or (len(digits) > 1 and digits.startswith(b"0")):
+        return None
+    prefix = len(digits) + 1
+    if prefix + int(digits) > capacity:
+        return None
+    return _characters(prefix + int(digits))[prefix:].decode("latin-1")
+
+
 class ImageInfo(object):
+    # Number of rows of pixels read at a time, kept even so vertical pairs of pixels never straddle two strips
+    rows_per_strip = 256
+
     def __init__(self, i, request=None, result=None, working_directory=None, logger=None):
 
         self.request = request
         self.result = result
         self.working_directory = working_directory
         self.log = logger
+        # Path, name and description of each supplementary file added to the request
+        self.supplementary_files = []
 
         if result:
             self.working_result = ResultSection("Image Steganography Module Results")
@@ -44,9 +95,14 @@ class ImageInfo(object):
             "RGBA": 4,
         }
 
+        # The image may be given as a path, or already decoded for the request
+        if not isinstance(i, DecodedImage):
+            i = DecodedImage(i)
+        self.decoded = i
+
         # Pillow seems to like non-corrupt images, so give its best shot and exit on error
         try:
-            img = Image.open(i)
+            img = i.image
         except Exception:
             raise NotSupported()
 
@@ -70,25 +126,37 @@ class ImageInfo(object):
         else:
             self.channels_to_process = supported_modes[self.imode]
 
+        # The pixel data is read one strip of rows at a time (see strips()), from these (start, stop) row ranges
+        width, height = self.isize
+        self.row_ranges = [(y, min(y + self.rows_per_strip, height)) for y in range(0, height, self.rows_per_strip)]
         try:
-            self.ipixels = iter(img.getdata())
+            # Images that can't be decoded are turned down here, rather than failing every module
+            self.decoded.rows(0, min(height, 2))
         except Exception:
             raise NotSupported()
 
-        try:
-            img = Image.open(i)
-            self.iobject = img.load()
-        except Exception:
-            raise NotSupported()
+        # Per-chunk histograms, shared by the LSB tests (see chunk_histograms())
+        self._histograms = None
+        # Fraction of the rows of the image that are analysed, and their width and number, see sample()
+        self.sampled_fraction = 1.0
+        self.analysed_size = self.isize
+        # Modules left out (or stopped part way through) by decloak() when its time budget ran out
+        self.skipped_modules = []
+        # Time (as per time.monotonic()) after which strips() stops, set by decloak()
+        self.deadline = None
+        self.set_chunk_size()
+
+    # --- Support Functions --------------------------------------------------------------------------------------------
 
-        # Values only get loaded into memory when used for deep_scan (ie. on decloak())
-        self.binary_pixels = None
-        self.pixel_count = self.isize[0] * self.isize[1] * self.channels_to_process
+    def set_chunk_size(self):
+        """Size the chunks of pixels the LSB tests are run on, from the number of pixel values analysed."""
+        self.pixel_count = self.analysed_size[0] * self.analysed_size[1] * self.channels_to_process
 
         # Chunk size equals (#bytes*8) bits/num byte-values per pixel. Therefore if 8 bits per pixel, and you want to
         # perform test on every 512 bytes of data, chunk size will be (512*8)/8 == every 512 pixels examined.
-        # Optimize chunk size if this is being run through AL
-        if request is not None:
+        # Optimize chunk size if this is being run through AL. The chunk size grows with the image, so large images
+        # still give the same number of chunks.
+        if self.request is not None:
             maximizer = self.pixel_count / 20000
             if maximizer == 0:
                 maximizer = 1
@@ -96,61 +164,173 @@ class ImageInfo(object):
         else:
             self.chunk = 256
 
-        self.chunk = int(self.chunk)
+        # Small images would otherwise get a chunk size of 0
+        self.chunk = max(int(self.chunk), 1)
         # total chunk bits/8
         self.chunk_bytes = (self.chunk * self.pixel_size * self.channels_to_process) / 8
 
-    # --- Support Functions --------------------------------------------------------------------------------------------
+    def sample(self, max_pixel_count, strip_height=16):
+        """Reduce a large image to evenly spaced strips of rows, so it can be analysed in bounded time.
 
-    @staticmethod
-    def convert_binary_string(mode, channels, p):
+        Strips of consecutive rows keep the pixels next to each other in both directions, as the sample pairs
+        analysis needs, while spreading the sample from the top of the image (where sequential embedding starts)
+        to the bottom. The image keeps its size (isize), and image_position() gives back where the pixels of the
+        sample are in the image.
 
-        if channels == 1:
-            for pi in p:
-                yield "{0:08b}".format(pi)
+        Args:
+            max_pixel_count: Maximum number of pixel values to keep.
+            strip_height: Number of consecutive rows in each strip, kept even so vertical pairs stay aligned.
 
-        else:
-            for pi in p:
-                pset = ()
-                for ip in pi[:channels]:
-                    pset += ("{0:08b}".format(ip),)
-                if mode == "RGBA":
-                    pset += ("{0:08b}".format(pi[-1]),)
-                yield pset
+        Returns:
+            The fraction of the rows of the image kept.
+        """
+        width, height = self.isize
+        rows = max(max_pixel_count // (width * self.channels_to_process) // strip_height, 1) * strip_height
+        if rows >= height:
+            return self.sampled_fraction
+
+        starts = np.linspace(0, height - strip_height, rows // strip_height).astype(np.int64) & ~1
+        self.row_ranges = [(int(start), int(start) + strip_height) for start in starts]
+        self._histograms = None
+        self.analysed_size = (width, rows)
+        self.sampled_fraction = rows / height
+        self.set_chunk_size()
+        return self.sampled_fraction
+
+    def strips(self):
+        """Iterate over the pixel data analysed, one strip of rows at a time.
+
+        Only one strip is decoded and held in memory at a time, so the modules accumulate their statistics strip by
+        strip and memory use is bounded by the size of a strip rather than the size of the image.
+
+        Yields:
+            uint8 arrays of shape (rows, width, channels), in image order.
+
+        Raises:
+            TimeBudgetExceeded: The deadline passed before the last strip.
+        """
+        for start, stop in self.row_ranges:
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                raise TimeBudgetExceeded()
+            strip = self.decoded.rows(start, stop)
+            yield np.asarray(strip, dtype=np.uint8).reshape(stop - start, self.isize[0], -1)
 
-    @staticmethod
-    def extract_pixels(i):
-        form = None
-        mode = None
-        size = None
-        pixels = None
-        # Pillow seems to like non-corrupt images, so give its best shot and exit on error
-        try:
-            img = Image.open(i)
-            form = img.format
-            mode = img.mode.upper()
-            size = img.size
-        except Exception:
-            raise NotSupported()
-        try:
-            pixels = list(img.getdata())
-        except Exception:
-            raise NotSupported()
-        return form, mode, size, pixels
+    def image_position(self, position):
+        """Position in the whole image of a pixel of the rows analysed, both counted row by row from the top left.
+
+        Positions past the rows analysed carry on past the end of the image.
+        """
+        width = self.isize[0]
+        row, column = divmod(position, width)
+        for start, stop in self.row_ranges:
+            if row < stop - start:
+                return (start + row) * width + column
+            row -= stop - start
+        return (self.isize[1] + row) * width + column
+
+    def chunk_lsb_byte(self, chunk):
+        """Byte of the LSB data of the whole image (1 bit per pixel value, not 8) that a chunk starts at.
+
+        Chunks are counted in the rows analysed, so the chunks of a sampled image are spread across the image.
+        """
+        return self.image_position(chunk * self.chunk) * self.channels_to_process / 8
+
+    def add_supplementary(self, file_path, name, description):
+        """Add a supplementary file to the request, keeping track of it."""
+        self.request.add_supplementary(file_path, name, description)
+        self.supplementary_files.append((file_path, name, description))
+
+    def bit_plane_montage(self, tile_size=256, border=2):
+        """Tile every bit plane of every channel into one greyscale image, each bit shown as 0 or 255.
+
+        Each row of tiles is a channel, and each column a bit from the most (left) to the least (right) significant.
+        Large images are subsampled (not averaged, which would blur the patterns in the planes) to fit the tiles. Only
+        the rows analysed are shown, so a sampled image shows its strips stacked together.
+
+        Args:
+            tile_size: Maximum width and height of each tile, in pixels.
+            border: Width of the grey border around each tile, in pixels.
+
+        Returns:
+            The montage, as a uint8 array of shape (height, width).
+        """
+        step = max(math.ceil(max(self.analysed_size) / tile_size), 1)
+        subsampled = []
+        top = 0
+        for strip in self.strips():
+            # Every step-th row of the image, counted from the top of the image rather than of the strip
+            subsampled.append(strip[-top % step :: step, ::step, : self.channels_to_process])
+            top += len(strip)
+        pixels = np.concatenate(subsampled)
+        bits = np.arange(7, -1, -1, dtype=np.uint8)
+        # Shaped (channels, bits, height, width)
+        planes = ((pixels.transpose(2, 0, 1)[:, None] >> bits.reshape(1, -1, 1, 1)) & 1) * np.uint8(255)
+        planes = np.pad(planes, ((0, 0), (0, 0), (border, border), (border, border)), constant_values=128)
+        channels, _, height, width = planes.shape
+        return planes.transpose(0, 2, 1, 3).reshape(channels * height, len(bits) * width)
+
+    def get_colours(self):
+        """Channel name and position of each colour channel to process, ie. {"R": 0, "G": 1, "B": 2}."""
+        return {self.imode[x]: x for x in range(0, self.channels_to_process)}
+
+    def chunk_histograms(self):
+        """Count the occurrences of every value, per channel, in each chunk of pixels.
+
+        The histograms are accumulated strip by strip, each pixel counted in the chunk its position in the image
+        falls in, and kept for the other LSB tests.
+
+        Returns:
+            Array of shape (chunks, channels, 256). The last chunk holds whatever pixels are left over.
+        """
+        if self._histograms is not None:
+            return self._histograms
+
+        channels = self.channels_to_process
+        chunks = -(-self.analysed_size[0] * self.analysed_size[1] // self.chunk)
+        histograms = np.zeros((chunks * 256, channels), dtype=np.int64)
+        position = 0
+        for strip in self.strips():
+            pixels = strip.reshape(-1, channels)
+            first, last = position // self.chunk, (position + len(pixels) - 1) // self.chunk
+            # Give every chunk its own range of 256 bins so one bincount covers all the chunks of a channel
+            bins = (np.arange(position, position + len(pixels)) // self.chunk - first) * 256
+            for pos in range(channels):
+                counts = np.bincount(bins + pixels[:, pos], minlength=(last - first + 1) * 256)
+                histograms[first * 256 : (last + 1) * 256, pos] += counts
+            position += len(pixels)
+        self._histograms = histograms.reshape(chunks, 256, channels).transpose(0, 2, 1)
+        return self._histograms
 
-    def get_colours(self, pixels, raw=False):
-        if raw:
-            colours = {self.imode[x]: pixels[x] for x in range(0, self.channels_to_process)}
-            return colours
+    @staticmethod
+    def sample_pairs(pixels):
+        """Count the sample pair classes of an image, per channel.
 
-        colour_format = {self.imode[x]: x for x in range(0, self.channels_to_process)}
-        colours = {self.imode[x]: [] for x in range(0, self.channels_to_process)}
+        Pairs are taken side by side across each row and then down each column, without overlap.
 
-        for p in pixels:
-            for c, pos in iter(colour_format.items()):
-                colours[c].append(p[pos])
+        Args:
+            pixels: uint8 array of shape (height, width, channels).
 
-        return colours
+        Returns:
+            Dictionary of P, W, X, Y and Z counts, each an array with one value per channel.
+        """
+        height, width = pixels.shape[:2]
+        across = pixels[:, : width - width % 2]
+        down = pixels[: height - height % 2]
+        channels = pixels.shape[2]
+        s1 = np.concatenate([across[:, 0::2].reshape(-1, channels), down[0::2].reshape(-1, channels)])
+        s2 = np.concatenate([across[:, 1::2].reshape(-1, channels), down[1::2].reshape(-1, channels)])
+
+        s2_even = (s2 & 1) == 0
+        greater = s2 > s1
+        lesser = s2 < s1
+        return {
+            "P": np.full(channels, s1.shape[0]),
+            # 6 msb are the same, but the lsb are different
+            "W": np.count_nonzero(((s1 >> 2) == (s2 >> 2)) & (((s1 ^ s2) & 1) == 1), axis=0),
+            "X": np.count_nonzero((s2_even & greater) | (~s2_even & lesser), axis=0),
+            "Y": np.count_nonzero((s2_even & lesser) | (~s2_even & greater), axis=0),
+            "Z": np.count_nonzero(s1 == s2, axis=0),
+        }
 
     def detect_sig_changes(self, data, thr_counter=0.5):
         sig_val = []
@@ -164,13 +344,10 @@ class ImageInfo(object):
 
         if len(sig_val) > 0:
             sig_res = ResultSection("Found significant change in randomness")
-            # Only account for LSB, therefore 1 bit per pixel, not 8
-            bits_per_group = self.chunk * self.channels_to_process
             if len(sig_val) == 1:
                 for start in sig_val:
-                    total_plot_span = (len(data) - start) + 1
-                    bytes_of_embed = int(round(float((total_plot_span * bits_per_group) / 8), 0))
-                    total_bytes = int(round(float((start * bits_per_group) / 8), 0))
+                    bytes_of_embed = int(round(self.chunk_lsb_byte(len(data) + 1) - self.chunk_lsb_byte(start), 0))
+                    total_bytes = int(round(self.chunk_lsb_byte(start), 0))
                     sig_res.add_line(
                         "{} bytes of possible random embedded data starting around byte {} of image.".format(
                             bytes_of_embed, total_bytes
@@ -178,9 +355,8 @@ class ImageInfo(object):
                     )
             else:
                 for i, (start, end) in enumerate(zip(sig_val, sig_val[1:])):
-                    total_plot_span = (end - start) + 1
-                    bytes_of_embed = int(round(float((total_plot_span * bits_per_group) / 8), 0))
-                    total_bytes = int(round(float((start * bits_per_group) / 8), 0))
+                    bytes_of_embed = int(round(self.chunk_lsb_byte(end + 1) - self.chunk_lsb_byte(start), 0))
+                    total_bytes = int(round(self.chunk_lsb_byte(start), 0))
                     sig_res.add_line(
                         "{} bytes of possible random embedded data starting around byte {} of image.".format(
                             bytes_of_embed, total_bytes
@@ -191,52 +367,52 @@ class ImageInfo(object):
 
         return
 
-    def iter_grayscale_pixels(self):
-        for pi in self.binary_pixels:
-            if int(pi[-1]) == 0:
-                yield 0
-            else:
-                yield 255
-
-    def iter_rgba_pixels(self):
-        for pi in self.binary_pixels:
-            pset = ()
-            for ip in pi[: self.channels_to_process]:
-                if int(ip[-1]) == 0:
-                    pset += (0,)
-                else:
-                    pset += (255,)
-
-            if self.imode == "RGBA":
-                pset += (int(pi[-1], 2),)
-            yield pset
-
     # --- LSB Functions ------------------------------------------------------------------------------------------------
     # 1
     def LSB_visual(self):
         """Convert pixel data so that each value in a pixel is either 0 (if LSB == 0) or 255 (if LSB == 1)"""
-        img = Image.new(self.imode, self.isize)
+        # Palette indices are rendered as greyscale, as the palette itself would not map 0 and 255 to black and white
+        # Only the rows analysed are shown, so a sampled image shows its strips stacked together
+        img = Image.new("L" if self.channels_to_process == 1 else self.imode, self.analysed_size)
         if self.working_directory is None:
             self.working_directory = path.dirname(__file__)
         try:
-            if self.channels_to_process == 1:
-                img.putdata(self.iter_grayscale_pixels())
-                success = True
-            else:
-                img.putdata(self.iter_rgba_pixels())
-                success = True
+            top = 0
+            for strip in self.strips():
+                visual = (strip & 1) * np.uint8(255)
+                if self.imode == "RGBA":
+                    # Keep the original transparency so the attack image renders like the source
+                    visual[..., 3] = strip[..., 3]
+                img.paste(Image.frombytes(img.mode, (img.width, len(strip)), visual.tobytes()), (0, top))
+                top += len(strip)
+            success = True
+        except TimeBudgetExceeded:
+            raise
         except Exception:
             success = False
 
         if success:
             lsb_visual_path = path.join(self.working_directory, "LSB_visual_attack.{}".format(self.iformat.lower()))
             img.save(lsb_visual_path)
+            montage_path = path.join(self.working_directory, "bit_plane_montage.png")
+            Image.fromarray(self.bit_plane_montage()).save(montage_path)
             # Save to AL supplementary file. Request should therefore be set and working_directory given.
             if self.request is not None:
-                self.request.add_supplementary(lsb_visual_path, "LSB_visual_attack", "Pixaxe LSB visual attack image")
+                sampled = " (rows sampled from the image, stacked together)" if self.sampled_fraction < 1 else ""
+                self.add_supplementary(lsb_visual_path, "LSB_visual_attack", f"Pixaxe LSB visual attack image{sampled}")
+                self.add_supplementary(
+                    montage_path,
+                    "bit_plane_montage",
+                    f"Pixaxe bit plane montage{sampled}: bits 7 to 0 from left to right, one row of planes per channel",
+                )
                 if self.result is not None:
                     visres = ResultSection("Visual LSB Analysis.\t")
                     visres.add_line("Visual LSB analysis successful, see extracted files.")
+                    if sampled:
+                        visres.add_line(
+                            f"The images only show the rows analysed ({self.sampled_fraction:.1%} of the image), "
+                            "stacked together, so they don't line up with the image."
+                        )
                     self.working_result.add_subsection(visres)
             else:
                 img.show()
@@ -244,7 +420,9 @@ class ImageInfo(object):
 
     # 2
     def LSB_chisquare(self):
-        pixels = self.binary_pixels
+        # Palette indices have no pairs of values to compare, so the attack only applies to colour channels
+        if self.channels_to_process == 1:
+            return
 
         x_points = []
         y_points = []
@@ -256,94 +434,43 @@ class ImageInfo(object):
             plt.title("Chi Square Test")
             plt.grid(True)
 
-        index = 0
         success = False
 
         try:
-            # If greyscale, only one set of pixels to process
-            if self.channels_to_process == 1:
-                while len(pixels) != 0:
-                    self.log.debug(len(pixels))
-                    # In bytes
-                    x_location = (self.chunk * self.channels_to_process) * index / 8
-                    x_points.append(x_location)
-
-                    obs_pixel_set = []
-                    exp_pixel_set = []
-                    # Let's grab some PoVs!!! Yay!!!
-                    for i in range(0, 255, 2):
-                        # Get counts
-                        v1 = pixels[: self.chunk].count(str("{0:08b}").format(i))
-                        v2 = pixels[: self.chunk].count(str("{0:08b}").format(i + 1))
-                        # Add observed values
-                        if v1 == 0 and v2 == 0:
-                            continue
-                        obs_pixel_set.append(v1)
-                        obs_pixel_set.append(v2)
-                        # Calculate expected values of pairs
-                        expected = float((v1 + v2) * 0.5)
-                        exp_pixel_set.extend([expected] * 2)
-
-                    if len(obs_pixel_set) == 0:
-                        y_points.append(0)
-                    else:
-                        y_points.append(round(chisquare(np.array(obs_pixel_set), f_exp=np.array(exp_pixel_set))[1], 4))
-                    pixels = pixels[self.chunk :]
-
-            else:
-                # If not greyscale, test each colour channel separately per chunk and then average
-                while len(pixels) != 0:
-                    x_location = (self.chunk * self.channels_to_process) * index / 8
-                    x_points.append(x_location)
-
-                    # Grab channel (i.e. R,G,B) pixels
-                    colours = self.get_colours(pixels[: self.chunk])
-                    counts = []
-                    lsb_counts = []
-
-                    for c, pixels_flat in iter(colours.items()):
-                        obs_pixel_set = []
-                        exp_pixel_set = []
-                        # Let's grab some PoVs!!! Yay!!!
-                        for i in range(0, 255, 2):
-                            # Get counts
-                            v1 = pixels_flat[: self.chunk].count(str("{0:08b}").format(i))
-                            v2 = pixels_flat[: self.chunk].count(str("{0:08b}").format(i + 1))
-                            # Add observed values
-                            if v1 == 0 and v2 == 0:
-                                continue
-                            obs_pixel_set.append(v1)
-                            obs_pixel_set.append(v2)
-                            # Calculate expected values of pairs
-                            expected = float((v1 + v2) * 0.5)
-                            exp_pixel_set.extend([expected] * 2)
-
-                        if len(obs_pixel_set) == 0:
-                            counts.append(0)
-                            if self.request is None:
-                                plt.scatter(x_location, 0, color=c, marker="^", s=50)
-
-                        else:
-                            chi = round(chisquare(np.array(obs_pixel_set), f_exp=np.array(exp_pixel_set))[1], 6)
-                            counts.append(chi)
-                            if self.request is None:
-                                plt.scatter(x_location, chi, color=c, marker="^", s=50)
-                        # Additionally, collect the LSBs for additional randomness testing.
-                        # Idea from http://guillermito2.net/stegano/tools/
-                        lsb = []
-                        for pbyte in pixels_flat:
-                            lsb.append(float(pbyte[-1]))
-                        lsb_avg_value = float(round(sum(lsb) / len(lsb), 1))
-                        if self.request is None:
-                            plt.scatter(x_location, lsb_avg_value, color="k", marker=".", s=10)
-                        lsb_counts.append(lsb_avg_value)
-
-                    # Average significance counts for the colours and round two 2 decimals
-                    y_points.append(round(sum(counts) / self.channels_to_process, 2))
-
-                    index += 1
-                    pixels = pixels[self.chunk :]
-                    success = True
+            # Test each colour channel separately per chunk and then average
+            histograms = self.chunk_histograms()
+            # Let's grab some PoVs!!! Yay!!!
+            pairs = histograms.reshape(-1, 128, 2)
+            # Pairs of values that never occur are left out of the test
+            used = pairs.sum(axis=-1) > 0
+            used_count = used.sum(axis=1)
+            chi = np.zeros(len(pairs))
+            # Chunks with the same number of pairs in use are tested together, one batch per distinct count
+            for count in np.unique(used_count[used_count > 0]):
+                rows = np.flatnonzero(used_count == count)
+                obs_pixel_set = pairs[rows][used[rows]].reshape(len(rows), count * 2)
+                # Calculate expected values of pairs
+                exp_pixel_set = (obs_pixel_set.reshape(len(rows), count, 2).sum(axis=-1) * 0.5).repeat(2, axis=-1)
+                chi[rows] = chisquare(obs_pixel_set, f_exp=exp_pixel_set, axis=1)[1]
+            chi = np.round(chi, 6).reshape(histograms.shape[:2])
+            # Additionally, collect the LSBs for additional randomness testing.
+            # Idea from http://guillermito2.net/stegano/tools/
+            lsb_avg_values = histograms[..., 1::2].sum(axis=-1) / histograms.sum(axis=-1)
+
+            for index, counts in enumerate(chi):
+                # In bytes
+                x_location = (self.chunk * self.channels_to_process) * index / 8
+                x_points.append(x_location)
+                if self.request is None:
+                    for c, pos in iter(self.get_colours().items()):
+                        plt.scatter(x_location, counts[pos], color=c, marker="^", s=50)
+                        plt.scatter(x_location, round(lsb_avg_values[index, pos], 1), color="k", marker=".", s=10)
+
+                # Average significance counts for the colours and round two 2 decimals
+                y_points.append(round(sum(counts) / self.channels_to_process, 2))
+                success = True
+        except TimeBudgetExceeded:
+            raise
         except Exception:
             success = False
 
@@ -375,47 +502,28 @@ class ImageInfo(object):
         if not self.request:
             return
 
-        pixels = self.binary_pixels
         lsb_points = []
         success = False
 
         try:
-            # If greyscale, only one set of pixels to process
+            # The LSB of each channel summed per chunk is the number of odd values in the chunk histograms
+            histograms = self.chunk_histograms()
+            lsb_sums = histograms[..., 1::2].sum(axis=-1)
+            chunk_sizes = histograms[:, 0].sum(axis=-1)
             if self.channels_to_process == 1:
-                while len(pixels) != 0:
-                    lsb = []
-                    for pbyte in pixels:
-                        lsb.append(float(pbyte[-1]))
-                    lsb_avg_value = round(sum(lsb) / len(lsb), 1)
-                    lsb_points.append(lsb_avg_value)
-                    pixels = pixels[self.chunk :]
-                    success = True
-
-            else:
-                lsb_points_channels = {}
-                # If not greyscale, test each colour channel separately per chunk and then average
-                while len(pixels) != 0:
-                    # Grab channel (i.e. R,G,B) pixels
-                    colours = self.get_colours(pixels[: self.chunk])
-                    lsb_counts = []
-
-                    for c, pixels_flat in iter(colours.items()):
-                        lsb = []
-                        for pbyte in pixels_flat:
-                            lsb.append(float(pbyte[-1]))
-                        lsb_avg_value = float(round(sum(lsb) / len(lsb), 1))
-                        lsb_counts.append(lsb_avg_value)
-                        if lsb_points_channels.get(c, None):
-                            lsb_points_channels[c].append(lsb_avg_value)
-                        else:
-                            lsb_points_channels[c] = []
-                            lsb_points_channels[c].append(lsb_avg_value)
+                # If greyscale, each point averages from the start of its chunk to the end of the image
+                lsb_sums = np.cumsum(lsb_sums[::-1], axis=0)[::-1]
+                chunk_sizes = np.cumsum(chunk_sizes[::-1])[::-1]
 
-                    # Average lsb counts for the colours and round two 2 decimals
-                    lsb_points.append(round(sum(lsb_counts) / self.channels_to_process, 2))
+            for chunk_averages in lsb_sums / chunk_sizes.reshape(-1, 1):
+                # Test each colour channel separately per chunk and then average
+                lsb_counts = [round(float(lsb_avg_value), 1) for lsb_avg_value in chunk_averages]
 
-                    pixels = pixels[self.chunk :]
-                    success = True
+                # Average lsb counts for the colours and round two 2 decimals
+                lsb_points.append(round(sum(lsb_counts) / self.channels_to_process, 2))
+                success = True
+        except TimeBudgetExceeded:
+            raise
         except Exception:
             success = False
 
@@ -440,8 +548,6 @@ class ImageInfo(object):
         https://github.com/b3dk7/StegExpose/blob/master/SamplePairs.java
         """
         success = False
-        width = self.isize[0]
-        height = self.isize[1]
         # P =   num of pairs
         # W =   num of pairs where 7 msb are the same, but the lsb are different
         # X =   num of pairs where :
@@ -467,73 +573,34 @@ class ImageInfo(object):
             "rd": 0,
         }
 
-        # Greyscale images
         try:
+            # Strips have an even number of rows, so the pairs counted per strip add up to those of the whole image
+            pairs = {}
+            for strip in self.strips():
+                for key, counts in self.sample_pairs(strip).items():
+                    pairs[key] = pairs.get(key, 0) + counts
             if self.channels_to_process == 1:
+                channel_names = [0]
+            else:
+                channel_names = [self.imode[x] for x in range(0, self.channels_to_process)]
 
-                # Pairs across image
-                for he in range(height):
-                    for wi in range(0, width - 1, 2):
-                        if wi + 1 > width:
-                            break
-                        # Get sample pairs
-                        s1 = self.iobject[wi, he]
-                        s2 = self.iobject[wi + 1, he]
-
-                        results["P"] += 1
-                        # Is Z?
-                        if s1 == s2:
-                            results["Z"] += 1
-                            continue
-                        s1b = "{0:08b}".format(s1)
-                        s2b = "{0:08b}".format(s2)
-                        # Is W?
-                        if s1b[:6] == s2b[:6] and s1b[7] != s2b[7]:
-                            results["W"] += 1
-                        # Is X? -- Lower value is odd
-                        if (s2b[7] == "0" and int(s2b) > int(s1b)) or (s2b[7] == "1" and int(s2b) < int(s1b)):
-                            results["X"] += 1
-                        # Is Y? -- Lower value is even
-                        if (s2b[7] == "0" and int(s2b) < int(s1b)) or (s2b[7] == "1" and int(s2b) > int(s1b)):
-                            results["Y"] += 1
-
-                # Pairs down image
-                for wi in range(width):
-                    for he in range(0, height - 1, 2):
-                        if he + 1 > height:
-                            break
-                        # Get sample pairs
-                        s1 = self.iobject[wi, he]
-                        s2 = self.iobject[wi, he + 1]
-
-                        results["P"] += 1
-                        # Is Z?
-                        if s1 == s2:
-                            results["Z"] += 1
-                            continue
-                        s1b = "{0:08b}".format(s1)
-                        s2b = "{0:08b}".format(s2)
-                        # Is W?
-                        if s1b[:6] == s2b[:6] and s1b[7] != s2b[7]:
-                            results["W"] += 1
-                        # Is X?
-                        if (s2b[7] == "0" and int(s2b) > int(s1b)) or (s2b[7] == "1" and int(s2b) < int(s1b)):
-                            results["X"] += 1
-                        # Is Y?
-                        if (s2b[7] == "0" and int(s2b) < int(s1b)) or (s2b[7] == "1" and int(s2b) > int(s1b)):
-                            results["Y"] += 1
+            colour_results = {}
+            for pos, k in enumerate(channel_names):
+                colour_results[k] = dict(results)
+                for key in ("P", "W", "X", "Y", "Z"):
+                    colour_results[k][key] = int(pairs[key][pos])
 
                 # quadratic equation is: ax ^ 2 + bx + c = 0
-                a = float(0.5 * (results["W"] + results["Z"]))
-                results["a"] = a
-                b = float(2 * results["X"] - results["P"])
-                results["b"] = b
-                c = float(results["Y"] - results["X"])
-                results["c"] = c
+                a = float(0.5 * (colour_results[k]["W"] + colour_results[k]["Z"]))
+                colour_results[k]["a"] = a
+                b = float(2 * colour_results[k]["X"] - colour_results[k]["P"])
+                colour_results[k]["b"] = b
+                c = float(colour_results[k]["Y"] - colour_results[k]["X"])
+                colour_results[k]["c"] = c
 
                 # If a == 0, assume straight line
                 if a == 0:
-                    results["final"] = abs(float(c / b))
+                    colour_results[k]["final"] = abs((float(c / b)))
                 else:
                     # Else take result as a curve
                     discriminant = float(b**2) - (4 * a * c)
@@ -543,114 +610,25 @@ class ImageInfo(object):
 
                         # return root with the smallest absolute value (as per paper)
                         if rootpos <= rootneg:
-                            results["final"] = rootpos
+                            colour_results[k]["final"] = rootpos
                         else:
-                            results["final"] = rootneg
+                            colour_results[k]["final"] = rootneg
                     else:
-                        results["final"] = "Something likely wrong"
+                        colour_results[k]["final"] = "Something likely wrong"
 
                 # In Andrew Ker's paper, "Improved Detection of LSB Steganography in Grayscale Images" he suggests
                 # dropping the message length (quadraic formula) and using relative difference instead ((Q-Q')/(Q+Q')).
                 # Will be a Pvalue 0f 0.0 to 1.0
-
-                e = float(results["Y"])
-                o = float(results["X"])
+                e = float(colour_results[k]["Y"])
+                o = float(colour_results[k]["X"])
                 rd = abs((e - o) / (e + o))
 
-                results["rd"] = rd
-                results = {0: results}
-
-            # Other images
-            else:
-                colour_results = {self.imode[x]: dict(results) for x in range(0, self.channels_to_process)}
-
-                # Pairs across image
-                for he in range(height):
-                    for wi in range(0, width - 1, 2):
-                        # Get sample pairs
-                        s1 = self.get_colours(list(self.iobject[wi, he]), raw=True)
-                        s2 = self.get_colours(list(self.iobject[wi + 1, he]), raw=True)
-
-                        for k, i in iter(s1.items()):
-                            colour_results[k]["P"] += 1
-                            # Is Z?
-                            if i == s2[k]:
-                                colour_results[k]["Z"] += 1
-                                continue
-                            s1b = "{0:08b}".format(i)
-                            s2b = "{0:08b}".format(s2[k])
-                            # Is W?
-                            if s1b[:6] == s2b[:6] and s1b[7] != s2b[7]:
-                                colour_results[k]["W"] += 1
-                            # Is X? -- Lower value is odd
-                            if (s2b[7] == "0" and int(s2b) > int(s1b)) or (s2b[7] == "1" and int(s2b) < int(s1b)):
-                                colour_results[k]["X"] += 1
-                            # Is Y? -- Lower value is even
-                            if (s2b[7] == "0" and int(s2b) < int(s1b)) or (s2b[7] == "1" and int(s2b) > int(s1b)):
-                                colour_results[k]["Y"] += 1
-
-                # Pairs down image
-                for wi in range(width):
-                    for he in range(0, height - 1, 2):
-                        # Get sample pairs
-                        s1 = self.get_colours(list(self.iobject[wi, he]), raw=True)
-                        s2 = self.get_colours(list(self.iobject[wi, he + 1]), raw=True)
-
-                        for k, i in iter(s1.items()):
-                            colour_results[k]["P"] += 1
-                            # Is Z?
-                            if i == s2[k]:
-                                colour_results[k]["Z"] += 1
-                                continue
-                            s1b = "{0:08b}".format(i)
-                            s2b = "{0:08b}".format(s2[k])
-                            # Is W?
-                            if s1b[:6] == s2b[:6] and s1b[7] != s2b[7]:
-                                colour_results[k]["W"] += 1
-                            # Is X?
-                            if (s2b[7] == "0" and int(s2b) > int(s1b)) or (s2b[7] == "1" and int(s2b) < int(s1b)):
-                                colour_results[k]["X"] += 1
-                            # Is Y?
-                            if (s2b[7] == "0" and int(s2b) < int(s1b)) or (s2b[7] == "1" and int(s2b) > int(s1b)):
-                                colour_results[k]["Y"] += 1
-
-                for k, i in iter(colour_results.items()):
-                    a = float(0.5 * (colour_results[k]["W"] + colour_results[k]["Z"]))
-                    colour_results[k]["a"] = a
-                    b = float(2 * colour_results[k]["X"] - colour_results[k]["P"])
-                    colour_results[k]["b"] = b
-                    c = float(colour_results[k]["Y"] - colour_results[k]["X"])
-                    colour_results[k]["c"] = c
-
-                    # If a == 0, assume straight line
-                    if a == 0:
-                        colour_results[k]["final"] = abs((float(c / b)))
-                    else:
-                        # Else take result as a curve
-                        discriminant = float(b**2) - (4 * a * c)
-                        if discriminant >= 0:
-                            rootpos = abs(float(((-1 * b) + math.sqrt(discriminant)) / (2 * a)))
-                            rootneg = abs(float(((-1 * b) - math.sqrt(discriminant)) / (2 * a)))
-
-                            # return root with the smallest absolute value (as per paper)
-                            if rootpos <= rootneg:
-                                colour_results[k]["final"] = rootpos
-                            else:
-                                colour_results[k]["final"] = rootneg
-                        else:
-                            colour_results[k]["final"] = "Something likely wrong"
-
-                    # In Andrew Ker's paper, he suggests dropping the message length (quadraic formula) and using
-                    # relative difference instead ((Q-Q')/(Q+Q')). Will be a value 0f 0.0 to 1.0
-                    e = float(colour_results[k]["Y"])
-                    o = float(colour_results[k]["X"])
-                    rd = abs((e - o) / (e + o))
-
-                    colour_results[k]["rd"] = rd
-
-                results = colour_results
+                colour_results[k]["rd"] = rd
 
+            results = colour_results
             success = True
+        except TimeBudgetExceeded:
+            raise
         except Exception:
             success = False
 
@@ -691,31 +669,37 @@ class ImageInfo(object):
         # Detection based on the noise floor of the image
         # Ref: https://github.com/target/strelka/blob/master/src/python/strelka/scanners/scan_nf.py
         try:
-            # Convert image to HSV color space
-            np_array = np.frombuffer(self.request.file_contents, np.uint8)
-            np_image = cv2.imdecode(np_array, cv2.IMREAD_IGNORE_ORIENTATION | cv2.IMREAD_COLOR)
-            if np_image is None:
-                # Couldn't create image from buffer for noise floor analysis
-                return
-            image = cv2.cvtColor(np_image, cv2.COLOR_BGR2HSV)
-
-            # Calculate histogram of saturation channel
-            s = cv2.calcHist([image], [1], None, [256], [0, 256])
+            # Calculate histogram of saturation channel, converting each strip to HSV color space (without any alpha
+            # channel)
+            s = np.zeros(256)
+            for strip in self.strips():
+                image = cv2.cvtColor(np.ascontiguousarray(strip[..., :3]), cv2.COLOR_RGB2HSV)
+                s += cv2.calcHist([image], [1], None, [256], [0, 256]).ravel()
 
             # Calculate percentage of pixels with saturation >= p
             p = 0.05
-            s_perc = float(np.sum(s[int(p * 255.0) : -1])) / float(np.prod(image.shape[0:2]))
+            s_perc = float(np.sum(s[int(p * 255.0) : -1])) / float(self.analysed_size[0] * self.analysed_size[1])
 
             # Percentage threshold; above: valid image, below: noise
             s_thr = 0.25
             section = ResultJSONSection("Noise Floor Analysis")
             section.set_json({"percentage": s_perc, "threshold": s_thr, "dangerous": s_perc < s_thr})
             self.working_result.add_subsection(section)
+        except TimeBudgetExceeded:
+            raise
         except Exception as e:
             self.log.error(f"Error loading image with cv2 library: {e}")
 
-    def decloak(self):
-        self.binary_pixels = list(self.convert_binary_string(self.imode, self.channels_to_process, self.ipixels))
+    def decloak(self, time_budget=None):
+        """Run every steganography module supported for the image mode.
+
+        The time budget is checked between the strips of pixel data the modules go through, so a module that is
+        still running when it runs out is stopped, and reported as skipped along with the modules left to run.
+
+        Args:
+            time_budget: Seconds after which the remaining modules are skipped, or None to run them all.
+        """
+        self.deadline = time.monotonic() + time_budget if time_budget is not None else None
         supported = {
             1: {
                 self.LSB_visual: [
@@ -754,7 +738,24 @@ class ImageInfo(object):
         for k, d in sorted(iter(supported.items())):
             for mod, l in iter(d.items()):
                 if self.imode in l:
-                    mod()
+                    if self.deadline is not None and time.monotonic() > self.deadline:
+                        self.skipped_modules.append(mod.__name__)
+                        continue
+                    try:
+                        mod()
+                    except TimeBudgetExceeded:
+                        self.skipped_modules.append(mod.__name__)
+        self.deadline = None
+
+        if self.sampled_fraction < 1 or self.skipped_modules:
+            # Results on part of the image, or from only some of the modules, are less conclusive
+            coverage = ResultKeyValueSection("Partial Analysis")
+            coverage.set_item("rows_analysed", f"{self.sampled_fraction:.1%}")
+            coverage.set_item("pixel_values_analysed", self.pixel_count)
+            if self.skipped_modules:
+                coverage.set_item("modules_skipped_by_time_budget", self.skipped_modules)
+            self.working_result.add_subsection(coverage)
+
         if len(self.working_result.subsections) > 0:
             self.result.add_subsection(self.working_result)
 
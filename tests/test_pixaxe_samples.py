@@ -1,9 +1,37 @@
+import gzip
+import hashlib
+import io
+import json
 import os
+import shutil
+import time
+import types
+import zipfile
 
+import cart
+import cv2
+import numpy as np
 import pytest
 from assemblyline.common.importing import load_module_by_path
 from assemblyline_service_utilities.testing.helper import TestHelper
-from pixaxe.helper import find_additional_content
+from assemblyline_v4_service.common.result import (
+    ResultGraphSection,
+    ResultKeyValueSection,
+    ResultMemoryDumpSection,
+    ResultSection,
+    ResultTableSection,
+    TableRow,
+)
+from PIL import Image
+
+from pixaxe.bitplanes import find_bitstream_payloads
+from pixaxe.cache import PerceptualIndex, ResultCache, dump_section, load_section
+from pixaxe.carve import carve_payloads
+from pixaxe.helper import find_additional_content, image_end, steghide_capable
+from pixaxe.image import DecodedImage, sample_frames
+from pixaxe.jpeg import dct_statistics, read_coefficients
+from pixaxe.qr import find_qr_codes, finder_patterns
+from pixaxe.steg import ImageInfo, TimeBudgetExceeded, reveal_message
 
 # Force manifest location
 os.environ["SERVICE_MANIFEST_PATH"] = os.path.join(os.path.dirname(__file__), "..", "service_manifest.yml")
@@ -22,9 +50,370 @@ def test_sample(sample):
     th.run_test_comparison(sample)
 
 
+def test_sample_cached(tmp_path):
+    # The cache is off by default. With it on, the second run is built from the cached output and must match the first.
+    sample = "f92ac68223525a47515ce885ab3f5accd37f181346dad79f8cf6b4f4690ee336"
+    shutil.copytree(os.path.join(RESULTS_FOLDER, sample), tmp_path / "results" / sample)
+    with open(tmp_path / "results" / sample / "params.json", "w") as fp:
+        json.dump({"config": {"cache_directory": str(tmp_path / "cache")}}, fp)
+
+    cached_th = TestHelper(service_class, str(tmp_path / "results"), SAMPLES_FOLDER)
+    cached_th.run_test_comparison(sample)
+    assert os.listdir(tmp_path / "cache")
+    cached_th.run_test_comparison(sample)
+
+
+def test_cached_incomplete(tmp_path):
+    service = service_class({"cache_directory": str(tmp_path)})
+    service.start()
+    request = types.SimpleNamespace(sha256="a" * 64)
+    # Output of an analysis cut short is returned, but not cached
+    assert service._cached(request, "qr", None, lambda: ([], False)) == []
+    assert service._cached(request, "qr", None, lambda: (["code"], True)) == ["code"]
+    assert service._cached(request, "qr", None, lambda: (["other"], True)) == ["code"]
+
+
+def test_near_duplicate_threshold(tmp_path):
+    # Thresholds the perceptual index can't look up are clamped
+    service = service_class({"cache_directory": str(tmp_path), "near_duplicate_threshold": 20})
+    service.start()
+    assert service.near_duplicate_threshold == service.index.chunks - 1
+
+
 @pytest.mark.parametrize("sample", ["complex.jpg", "simple.gif", "helloworld.bmp"])
 def test_find_additional_content(sample):
     with open(os.path.join(SAMPLES_FOLDER, sample), "rb") as fp:
         data = fp.read()
 
     assert find_additional_content(data)
+
+
+@pytest.mark.parametrize("sample, file_type", [("complex.jpg", "archive/rar"), ("simple.gif", "archive/zip")])
+def test_carve_payloads(sample, file_type):
+    with open(os.path.join(SAMPLES_FOLDER, sample), "rb") as fp:
+        data = fp.read()
+
+    payloads = carve_payloads(data, image_end(data))
+    assert [payload.file_type for payload in payloads] == [file_type]
+    assert payloads[0].offset == image_end(data)
+
+
+def test_carve_chained_payloads():
+    with open(os.path.join(SAMPLES_FOLDER, "helloworld.bmp"), "rb") as fp:
+        data = fp.read()
+    # A ZIP archive holding another (stored as is, so its end of central directory record shows), then a gzip stream
+    inner = io.BytesIO()
+    with zipfile.ZipFile(inner, "w") as archive:
+        archive.writestr("inner.txt", "hello")
+    outer = io.BytesIO()
+    with zipfile.ZipFile(outer, "w") as archive:
+        archive.writestr("inner.zip", inner.getvalue())
+        archive.writestr("outer.txt", "world")
+    compressed = gzip.compress(b"payload" * 100)
+    end = image_end(data)
+    data = data[:end] + outer.getvalue() + compressed
+
+    payloads = carve_payloads(data, end)
+    assert [(p.file_type, p.offset, p.end) for p in payloads] == [
+        ("archive/zip", end, end + len(outer.getvalue())),
+        ("archive/gzip", end + len(outer.getvalue()), len(data)),
+    ]
+    # A gzip signature turning up in other data isn't carved
+    assert carve_payloads(b"\x1F\x8B\x08\x00" + bytes(range(256)) * 4) == []
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        # Cabinet file with a size of 0
+        b"\x4D\x53\x43\x46\x00\x00\x00\x00" + bytes(28),
+        # BMP header with a file size and pixel data offset of 0
+        b"\x42\x4D" + bytes(36),
+    ],
+)
+def test_carve_empty_payloads(header):
+    # Payloads ending where they start aren't carved, and don't stop the scan from moving forward
+    data = b"A" * 100 + header + bytes(100)
+    assert image_end(data, 100) is None
+    assert carve_payloads(data) == []
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path), 2048, "1.0.0")
+    cache.set("a" * 64, "ocr", "text")
+    assert cache.get("a" * 64, "ocr") == "text"
+    assert cache.get("a" * 64, "ocr", ["other params"]) is None
+    assert ResultCache(str(tmp_path), 2048, "2.0.0").get("a" * 64, "ocr") is None
+
+    # Filling the cache past its size evicts the least recently used entries
+    for i in range(10):
+        cache.set(str(i) * 64, "ocr", "x" * 500)
+    assert cache.get("9" * 64, "ocr") == "x" * 500
+    assert cache.get("a" * 64, "ocr") is None
+
+
+def test_cached_section():
+    section = ResultSection("Results", body="text", tags={"file.string.extracted": ["hidden"]})
+    section.set_heuristic(1, signature="lsb")
+    ResultKeyValueSection("Coverage", body={"rows_analysed": 16}, parent=section)
+    graph = ResultGraphSection("Colour map", parent=section)
+    graph.set_colormap(0, 100, [1, 2, 3])
+    ResultMemoryDumpSection("Couples", body="00 01", parent=section)
+    table = ResultTableSection("Payloads", parent=section)
+    table.add_row(TableRow(configuration="b1,rgb,lsb,xy", size=10))
+
+    # The section goes through JSON like a cache entry
+    loaded = load_section(json.loads(json.dumps(dump_section(section))))
+
+    assert [type(subsection) for subsection in loaded.subsections] == [
+        type(subsection) for subsection in section.subsections
+    ]
+    assert [subsection.body for subsection in loaded.subsections] == [
+        subsection.body for subsection in section.subsections
+    ]
+    assert loaded.tags == section.tags
+    assert loaded.heuristic.signatures == {"lsb": 1}
+    assert loaded.heuristic.score == section.heuristic.score
+    assert loaded.subsections[3].body_config == section.subsections[3].body_config
+
+
+def test_perceptual_index(tmp_path):
+    index = PerceptualIndex(str(tmp_path / "index.txt"))
+    index.add(0xF0F0 << 128, "a" * 64)
+    index.add(0xFFFF << 128, "b" * 64)
+
+    assert index.nearest((0xF0F0 << 128) | 0b111, 4) == ("a" * 64, 3)
+    assert index.nearest(0xF0F0 << 128, 4, exclude="a" * 64) is None
+    # The index is reloaded from disk
+    assert PerceptualIndex(str(tmp_path / "index.txt")).nearest(0xFFFF << 128, 0) == ("b" * 64, 0)
+
+
+@pytest.mark.parametrize("file_name", ["strips.bmp", "strips.png"])
+def test_decoded_image_rows(tmp_path, file_name):
+    pixels = np.random.default_rng(0).integers(0, 256, (37, 29, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(tmp_path / file_name)
+
+    # BMP rows are read from the file bottom-up, PNG rows decoded in order from the compressed data
+    with DecodedImage(str(tmp_path / file_name)) as decoded:
+        strips = [decoded.rows(start, min(start + 8, 37)) for start in range(0, 37, 8)]
+        # Going back to earlier rows starts over
+        assert np.array_equal(decoded.rows(3, 5), pixels[3:5])
+        # Pillow never decoded the whole image
+        assert decoded.image.tile
+    assert np.array_equal(np.concatenate(strips), pixels)
+
+
+def test_jpeg_dct_statistics():
+    stats = dct_statistics(read_coefficients(os.path.join(SAMPLES_FOLDER, "complex.jpg")))
+
+    assert stats["blocks"] and stats["non_zero_ac"]
+    # A plain photo: the pairs of values are nowhere near even
+    assert max(stats["pair_of_values"]) < 0.05
+    assert not stats["f5_encoder"]
+
+
+def test_reveal_message(tmp_path):
+    # Message hidden the way stegano does: LSB of each colour value, with the length and a colon first
+    pixels = np.random.default_rng(0).integers(0, 256, (10, 10, 3), dtype=np.uint8)
+    bits = np.unpackbits(np.frombuffer(b"5:hello", dtype=np.uint8))
+    pixels.reshape(-1)[: len(bits)] = (pixels.reshape(-1)[: len(bits)] & 0xFE) | bits
+    Image.fromarray(pixels).save(tmp_path / "message.png")
+    Image.fromarray(np.zeros((10, 10, 3), dtype=np.uint8)).save(tmp_path / "blank.png")
+
+    with DecodedImage(str(tmp_path / "message.png")) as decoded:
+        assert reveal_message(decoded) == "hello"
+    with DecodedImage(str(tmp_path / "blank.png")) as decoded:
+        assert reveal_message(decoded) is None
+
+
+def test_decloak_time_budget(tmp_path):
+    Image.fromarray(np.random.default_rng(0).integers(0, 256, (600, 40, 3), dtype=np.uint8)).save(tmp_path / "big.png")
+    info = ImageInfo(str(tmp_path / "big.png"), result=ResultSection("Steganography"), working_directory=str(tmp_path))
+
+    # The deadline is checked between strips, stopping a module part way through the image
+    info.deadline = time.monotonic() - 1
+    with pytest.raises(TimeBudgetExceeded):
+        info.LSB_couples()
+    assert not info.working_result.subsections
+
+    # Modules stopped or left out are reported as skipped
+    info.decloak(time_budget=0)
+    assert info.deadline is None
+    assert info.skipped_modules == ["LSB_visual", "LSB_chisquare", "LSB_averages", "LSB_couples", "NF"]
+    [partial] = info.working_result.subsections
+    assert partial.title_text == "Partial Analysis"
+    assert json.loads(partial.body)["modules_skipped_by_time_budget"] == info.skipped_modules
+
+
+def test_decloak_sampled(tmp_path):
+    Image.fromarray(np.random.default_rng(0).integers(0, 256, (600, 40, 3), dtype=np.uint8)).save(tmp_path / "big.png")
+    info = ImageInfo(str(tmp_path / "big.png"), result=ResultSection("Steganography"), working_directory=str(tmp_path))
+
+    # Strips of 16 rows adding up to at most 12000 pixel values
+    assert info.sample(12000) == 0.16
+    assert sum(len(strip) for strip in info.strips()) == 96
+    # The image keeps its size, and positions in the sample are given back in the image
+    assert info.isize == (40, 600) and info.analysed_size == (40, 96)
+    assert info.image_position(16 * 40 + 3) == info.row_ranges[1][0] * 40 + 3
+    info.decloak(time_budget=0)
+    [partial] = info.working_result.subsections
+    assert json.loads(partial.body) == {
+        "rows_analysed": "16.0%",
+        "pixel_values_analysed": 96 * 40 * 3,
+        "modules_skipped_by_time_budget": ["LSB_visual", "LSB_chisquare", "LSB_averages", "LSB_couples", "NF"],
+    }
+
+
+def test_find_bitstream_payloads(tmp_path):
+    # Text hidden in the second bit plane of the blue channel, down the columns, least significant bit first
+    text = b"The quick brown fox jumps over the lazy dog"
+    pixels = np.random.default_rng(0).integers(0, 256, (40, 40, 3), dtype=np.uint8)
+    bits = np.unpackbits(np.frombuffer(text + b"\x00", dtype=np.uint8), bitorder="little")
+    blue = pixels[..., 2].T.reshape(-1)
+    blue[: len(bits)] = (blue[: len(bits)] & 0xFD) | bits << 1
+    pixels[..., 2] = blue.reshape(40, 40).T
+    Image.fromarray(pixels).save(tmp_path / "bitstream.png")
+
+    with DecodedImage(str(tmp_path / "bitstream.png")) as decoded:
+        payloads = list(find_bitstream_payloads(decoded))
+        # Nothing is read once the deadline has passed
+        with pytest.raises(TimeBudgetExceeded):
+            list(find_bitstream_payloads(decoded, deadline=time.monotonic() - 1))
+    assert [(p.config.name, p.file_type, p.data) for p in payloads] == [("bit1,b,lsb,yx", "text", text)]
+
+    # Reading the start of the bitstreams down the columns already stops at the deadline
+    Image.fromarray(np.random.default_rng(1).integers(0, 256, (40, 40, 3), dtype=np.uint8)).save(tmp_path / "plain.png")
+    with DecodedImage(str(tmp_path / "plain.png")) as decoded:
+        assert list(find_bitstream_payloads(decoded)) == []
+        with pytest.raises(TimeBudgetExceeded):
+            list(find_bitstream_payloads(decoded, deadline=time.monotonic() - 1))
+
+
+def test_lsb_modules(tmp_path):
+    # Gradients with a little noise, random LSBs in the top half. The expected results are those of the modules before
+    # they were vectorised, when they went through the pixels one binary string at a time.
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:48, 0:64]
+    pixels = (np.stack([x * 3, y * 4, x + y], axis=-1) + rng.integers(0, 8, (48, 64, 3))).astype(np.uint8)
+    pixels[:24] = (pixels[:24] & 0xFE) | rng.integers(0, 2, (24, 64, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(tmp_path / "lsb.png")
+
+    info = ImageInfo(str(tmp_path / "lsb.png"), request=object(), result=ResultSection("Steganography"))
+    info.LSB_chisquare()
+    info.LSB_averages()
+    info.LSB_couples()
+    chisquare, averages, couples = info.working_result.subsections
+
+    # Chunks of 58 pixels, 53 chunks
+    assert json.loads(chisquare.subsections[0].body)["data"]["values"] == [
+        100.0, 99.0, 94.0, 77.0, 100.0, 100.0, 100.0, 98.0, 98.0, 94.0, 99.0, 87.0, 98.0, 97.0, 88.0, 68.0, 83.0, 99.0,
+        69.0, 95.0, 95.0, 96.0, 92.0, 99.0, 99.0, 99.0, 99.0, 98.0, 100.0, 100.0, 90.0, 100.0, 99.0, 92.0, 98.0, 100.0,
+        100.0, 100.0, 96.0, 91.0, 99.0, 97.0, 91.0, 100.0, 97.0, 99.0, 83.0, 84.0, 92.0, 99.0, 100.0, 99.0, 93.0,
+    ]  # fmt: skip
+    assert json.loads(averages.subsections[0].body)["data"]["values"] == pytest.approx(
+        [
+            43, 60, 50, 50, 57, 50, 50, 47, 47, 50, 50, 53, 53, 57, 50, 43, 50, 47, 53, 53, 53, 50, 47, 57, 53, 47, 53,
+            40, 50, 53, 57, 53, 50, 53, 57, 50, 47, 47, 53, 50, 47, 43, 47, 47, 57, 50, 50, 53, 47, 57, 47, 50, 50,
+        ]
+    )  # fmt: skip
+    assert couples.body == (
+        "R Pixel Results: 22.121077014486954%\n"
+        "G Pixel Results: Something likely wrong\n"
+        "B Pixel Results: Something likely wrong\n"
+        "Likelyhood of hidden message: 0.05525486968457527 (P value).\n"
+        "Combined length results: 22.121077014486954% of image possibly embedded with a hidden message."
+    )
+
+
+def test_sample_frames():
+    changes = [0, 3, 40, 2, 1, 35, 4, 0, 2, 50, 1, 3]
+    # First and last frames, the two biggest scene changes, and evenly spaced frames for the rest
+    assert sample_frames(changes, 6) == [0, 2, 4, 7, 9, 11]
+    assert sample_frames(changes, 2) == [0, 11]
+    assert sample_frames(changes, 1) == [0]
+    assert sample_frames(changes, 0) == list(range(12))
+    assert sample_frames(changes, 20) == list(range(12))
+
+
+def test_gif_frames(tmp_path):
+    # Three scenes, the first two each followed by a copy with a single pixel changed
+    rng = np.random.default_rng(0)
+    scenes = [np.kron(rng.integers(0, 2, (8, 8)), np.ones((8, 8))).astype(np.uint8) * 255 for _ in range(3)]
+    frames = []
+    for scene in scenes[:2]:
+        touched = scene.copy()
+        touched[0, 0] ^= 255
+        frames += [scene, touched]
+    frames.append(scenes[2])
+    images = [Image.fromarray(frame).convert("P") for frame in frames]
+    images[0].save(tmp_path / "frames.gif", save_all=True, append_images=images[1:], duration=100)
+
+    with open(tmp_path / "frames.gif", "rb") as fp:
+        sample = hashlib.sha256(fp.read()).hexdigest()
+    os.makedirs(tmp_path / "samples")
+    cart.pack_file(str(tmp_path / "frames.gif"), str(tmp_path / "samples" / f"{sample}.cart"))
+    frame_files = {}
+    for params in [
+        {"config": {"max_ocr_frames": 2}},
+        # Few enough frames to keep them all in the first pass
+        {"config": {"max_ocr_frames": 3}},
+        {"config": {"max_ocr_frames": 2}, "submission_params": {"max_ocr_frames": -1}},
+    ]:
+        os.makedirs(tmp_path / "results" / sample, exist_ok=True)
+        with open(tmp_path / "results" / sample / "params.json", "w") as fp:
+            json.dump(params, fp)
+
+        TestHelper(service_class, str(tmp_path / "results"), str(tmp_path / "samples")).regenerate_results(
+            sample_sha256=sample
+        )
+        with open(tmp_path / "results" / sample / "result.json") as fp:
+            result = json.load(fp)
+        sections = {section["title_text"]: section["body"] for section in result["extra"]["sections"]}
+        # The copies are skipped
+        assert sections["Duplicate GIF frames skipped"] == {"frame_1": "frame_0", "frame_3": "frame_2"}
+        frame_files[json.dumps(params)] = {
+            f["name"][len(sample) + 1 :]: f["sha256"]
+            for f in result["files"]["supplementary"]
+            if "_frame_" in f["name"]
+        }
+        if params["config"]["max_ocr_frames"] == 2 and "submission_params" not in params:
+            # Of the three frames left only the first and last are kept, and written out
+            assert sections["GIF frames skipped by frame sampling"] == {"skipped_frames": ["frame_2"]}
+            assert sorted(frame_files[json.dumps(params)]) == ["frame_0", "frame_0.thumb", "frame_4", "frame_4.thumb"]
+        else:
+            assert "GIF frames skipped by frame sampling" not in sections
+
+    # The frames are the same whether they are written out in the first pass or decoded again once sampled
+    sampled, first_pass, every_frame = frame_files.values()
+    assert first_pass == every_frame
+    assert sampled.items() <= first_pass.items()
+
+
+def test_qr_codes():
+    code = cv2.QRCodeEncoder.create().encode("https://example.com/qr")
+    # Modules of 8 pixels, with a quiet zone of 2 modules
+    code = cv2.resize(code, None, fx=8, fy=8, interpolation=cv2.INTER_NEAREST)
+    image = np.random.default_rng(0).integers(96, 160, (1200, 1500), dtype=np.uint8)
+    image[700 : 700 + code.shape[0], 900 : 900 + code.shape[1]] = code
+
+    # The three corners of the code, among whatever else looks like a finder pattern
+    patterns = finder_patterns(image)
+    assert {(916, 716, 56, 56), (1060, 716, 56, 56), (916, 860, 56, 56)} <= set(patterns)
+    assert find_qr_codes(image) == (["https://example.com/qr"], True)
+    assert find_qr_codes(255 - image) == (["https://example.com/qr"], True)
+    # Nothing is decoded without finder patterns
+    assert find_qr_codes(np.full((600, 800), 255, dtype=np.uint8)) == ([], True)
+    # Searches cut short by the time budget are reported as such
+    assert find_qr_codes(image, time_budget=0) == ([], False)
+
+
+def test_steghide_capable():
+    for sample in ("complex.jpg", "helloworld.bmp"):
+        with open(os.path.join(SAMPLES_FOLDER, sample), "rb") as fp:
+            assert steghide_capable(fp.read(18))
+    assert steghide_capable(b"RIFF\x24\x08\x00\x00WAVEfmt ")
+    assert steghide_capable(b".snd\x00\x00\x00\x18")
+    assert not steghide_capable(b"RIFF\x24\x08\x00\x00AVI LIST")
+    assert not steghide_capable(b"\x89PNG\r\n\x1A\n\x00\x00\x00\x0DIHDR")
+    # BMP headers are checked beyond their two byte signature
+    assert not steghide_capable(b"BM" + bytes(16))